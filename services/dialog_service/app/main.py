@@ -1,27 +1,29 @@
 import os
 import re
-import json
 import time
-from typing import Any, Dict, Optional, Tuple, Literal, List
+import unicodedata
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import (
+    Any, AsyncIterator, Awaitable, Callable, Dict, FrozenSet, Optional, Tuple, Literal, List,
+)
 
-import requests
+import ahocorasick
+import httpx
+import msgpack
+import orjson
+import redis.asyncio as redis
+from redis.asyncio.cluster import RedisCluster
 from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from openai import OpenAI
-
-app = FastAPI()
-
-# Для теста можно "*", для нормальной работы — конкретный домен GitHub Pages
-origins = ["https://sergeybritok.github.io"]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,      # или ["*"] для быстрого теста
-    allow_credentials=False,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+from openai import AsyncOpenAI
 
 # =========================
 # ENV / CONFIG
@@ -37,20 +39,104 @@ TARIFF_BEARER = os.getenv("TARIFF_BEARER", "").strip()
 
 ALLOW_ORIGINS = os.getenv("ALLOW_ORIGINS", "*").strip()
 SESSION_TTL_SEC = int(os.getenv("SESSION_TTL_SEC", "3600"))  # 1 hour
+# A crashed holder's Redis lock expires after this; it must outlast the longest turn, which
+# the LLM/tariff timeouts below bound (checked at import)
+SESSION_LOCK_TTL_MS = int(os.getenv("SESSION_LOCK_TTL_MS", "30000"))
+# How long a turn waits for the previous turn of its session before answering 409
+SESSION_LOCK_WAIT_MS = int(os.getenv("SESSION_LOCK_WAIT_MS", "10000"))
+# Cap for the in-memory store; the least recently used session is evicted past it
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "100000"))
+
+# Shared session store; in-memory fallback when not set (single worker only)
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+# Redis Cluster shards keys by hash slot of sess:<session_id>; every command here is single-key
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "").strip().lower() in ("1", "true", "yes")
+# Per command, connect included: a stalled Redis fails the command instead of the turn
+# outliving its session lock
+REDIS_TIMEOUT_SEC = float(os.getenv("REDIS_TIMEOUT_SEC", "0.5"))
+_redis: Optional[redis.Redis] = None
+if REDIS_URL:
+    _redis = (RedisCluster if REDIS_CLUSTER else redis.Redis).from_url(
+        REDIS_URL, socket_timeout=REDIS_TIMEOUT_SEC, socket_connect_timeout=REDIS_TIMEOUT_SEC
+    )
+
+async def _redis_op(aw: Awaitable[Any]) -> Any:
+    # Hard bound on top of the socket timeouts, which cluster retries would multiply
+    async with asyncio.timeout(REDIS_TIMEOUT_SEC):
+        return await aw
+
+log = logging.getLogger("dialog_service")
 
 # Retry controls for LLM cargo classification
 CARGO_RETRY_MAX = int(os.getenv("CARGO_RETRY_MAX", "2"))      # additional user-triggered retries
 LLM_ATTEMPTS_PER_TRY = int(os.getenv("LLM_ATTEMPTS_PER_TRY", "3"))
 LLM_BASE_DELAY_SEC = float(os.getenv("LLM_BASE_DELAY_SEC", "0.6"))
+LLM_TIMEOUT_SEC = float(os.getenv("LLM_TIMEOUT_SEC", "8"))  # per attempt, batch fallback included
+TARIFF_TIMEOUT_SEC = float(os.getenv("TARIFF_TIMEOUT_SEC", "10"))  # whole call, retry included
+
+# Micro-batching of concurrent cargo classifications into one LLM request
+CARGO_BATCH_MAX = int(os.getenv("CARGO_BATCH_MAX", "8"))
+CARGO_BATCH_WAIT_MS = int(os.getenv("CARGO_BATCH_WAIT_MS", "50"))
+
+# LRU of successful classifications by normalized description, mirrored to Redis when set
+CLASSIFY_CACHE_SIZE = int(os.getenv("CLASSIFY_CACHE_SIZE", "4096"))
+CLASSIFY_CACHE_TTL_SEC = int(os.getenv("CLASSIFY_CACHE_TTL_SEC", str(30 * 24 * 3600)))  # 30 days
+
+# Worst-case turn: every LLM attempt times out (plus the backoff sleeps), or the tariff call
+# does; on top, each Redis command a turn makes while holding the lock may time out
+# (session load, classification cache read and write, session save)
+_REDIS_OPS_PER_TURN = 4 if REDIS_URL else 0
+_TURN_BUDGET_SEC = max(
+    LLM_ATTEMPTS_PER_TRY * LLM_TIMEOUT_SEC
+    + LLM_BASE_DELAY_SEC * LLM_ATTEMPTS_PER_TRY * (LLM_ATTEMPTS_PER_TRY - 1) / 2,
+    TARIFF_TIMEOUT_SEC,
+) + _REDIS_OPS_PER_TURN * REDIS_TIMEOUT_SEC
+if _TURN_BUDGET_SEC * 1000 >= SESSION_LOCK_TTL_MS:
+    raise RuntimeError(
+        f"SESSION_LOCK_TTL_MS={SESSION_LOCK_TTL_MS} does not cover a {_TURN_BUDGET_SEC:.1f}s turn; "
+        "raise it or lower LLM_TIMEOUT_SEC / LLM_ATTEMPTS_PER_TRY / TARIFF_TIMEOUT_SEC / "
+        "REDIS_TIMEOUT_SEC"
+    )
 
 # Debug size limits
 DEBUG_MAX_TEXT = int(os.getenv("DEBUG_MAX_TEXT", "4000"))
+_UTC = timezone.utc
 
 # Strict options (align with tariff_service)
 FRANCHISE_OPTIONS = [20000, 50000]
 ROUTE_OPTIONS = ["РФ", "СНГ-РФ", "ВЕСЬ МИР-РФ"]
+_ROUTE_OPTIONS_SET: FrozenSet[str] = frozenset(ROUTE_OPTIONS)
 CONDITION_OPTIONS = ["NEW", "USED"]
 
+# =========================
+# FastAPI app + CORS
+# =========================
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # The tariff pool, the cargo batcher and the Redis pool live for the worker's lifetime
+    _batcher.start()
+    try:
+        yield
+    finally:
+        _prefetch_cancel_all()
+        await _batcher.stop()
+        await _close_tariff_client()
+        if _redis is not None:
+            await _redis.aclose()
+
+app = FastAPI(
+    title="Insurance Dialog Service", default_response_class=ORJSONResponse, lifespan=lifespan
+)
+
+origins = ["*"] if ALLOW_ORIGINS == "*" else [o.strip() for o in ALLOW_ORIGINS.split(",") if o.strip()]
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=False,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 # =========================
 # Cargo whitelist (safe)
 # =========================
@@ -72,17 +158,23 @@ CARGO_CLASSES: Dict[str, str] = {
     "CARGO015": "Металлопрокат и изделия из металла (металлоизделия)",
     "CARGO016": "Химическая продукция неопасная (не классифицируемая как опасный груз/ADR)",
 }
-CARGO_ORDER = list(CARGO_CLASSES.keys())
+# Menu order for manual choice and O(1) whitelist membership, built once
+_CARGO_KEYS: Tuple[str, ...] = tuple(CARGO_CLASSES)
+_CARGO_KEYS_SET: FrozenSet[str] = frozenset(_CARGO_KEYS)
 
 # =========================
 # LLM client (ONLY for cargo classification)
 # =========================
-_client: Optional[OpenAI] = None
+_client: Optional[AsyncOpenAI] = None
 if YANDEX_FOLDER_ID and YANDEX_API_KEY:
-    _client = OpenAI(
+    _client = AsyncOpenAI(
         api_key=YANDEX_API_KEY,
         base_url=YANDEX_BASE_URL,
         project=YANDEX_FOLDER_ID,
+        # llm_classify_cargo owns the retries; the SDK's own (and its 600s default) would
+        # stretch a turn past the session lock
+        timeout=LLM_TIMEOUT_SEC,
+        max_retries=0,
     )
 
 def _default_model() -> Optional[str]:
@@ -95,6 +187,244 @@ def _default_model() -> Optional[str]:
 
 LLMStatus = Literal["ok", "uncertain", "error"]
 
+# The prompt only depends on CARGO_CLASSES, so it is built once at import.
+_CARGO_WHITELIST_JSON = orjson.dumps(CARGO_CLASSES).decode()
+_SYSTEM_MSG: Dict[str, str] = {
+    "role": "system",
+    "content": (
+        "Ты классификатор грузов для страхования грузоперевозок. "
+        "Тебе дано описание груза и белый список допустимых классов. "
+        "Верни строго JSON без лишнего текста. "
+        "Если не уверен или груз не подходит — верни cargo_class_id=null.\n\n"
+        f"Белый список (id -> name): {_CARGO_WHITELIST_JSON}"
+    ),
+}
+
+def _cargo_user_msg(desc: str) -> str:
+    return (
+        f"Описание груза: {desc}\n"
+        "Верни JSON: {\"cargo_class_id\": string|null, \"confidence\": 0..1, \"reason\": string}"
+    )
+
+def _cargo_batch_user_msg(descs: List[str]) -> str:
+    items = [{"id": str(i), "desc": d} for i, d in enumerate(descs, start=1)]
+    return (
+        f"Описания грузов: {orjson.dumps(items).decode()}\n"
+        "Классифицируй каждый груз отдельно. Верни JSON-массив: "
+        "[{\"id\": string, \"cargo_class_id\": string|null, "
+        "\"confidence\": 0..1, \"reason\": string}]"
+    )
+
+class CargoBatcher:
+    """
+    Collects cargo descriptions for up to wait_ms (or max_batch items) and
+    classifies them with a single LLM request, so concurrent chats share one
+    round-trip and one copy of the system prompt.
+    submit() returns (user_msg, raw_response, parsed_item, batch_size) for its own
+    description and raises if the request failed or no answer could be parsed for it.
+    For a batched request user_msg and raw_response are only this description's entry
+    and its answer: the rest of the prompt belongs to other chats and never leaves here.
+    Items a batched answer drops or garbles are re-asked one by one, so one odd
+    description cannot fail (or burn the retries of) the other chats in its batch.
+    """
+
+    def __init__(self, max_batch: int, wait_ms: int) -> None:
+        self.max_batch = max(1, max_batch)
+        self.wait_sec = wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Strong refs to in-flight requests; the loop only keeps weak ones
+        self._inflight: set = set()
+
+    def start(self) -> None:
+        """Starts the collector on the running loop (called from the app lifespan)."""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run(self._queue))
+        # Requests still in flight on an earlier loop can't be awaited from this one
+        self._inflight = set()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def submit(self, desc: str, batch: bool = True) -> Tuple[str, str, Any, int]:
+        loop = asyncio.get_running_loop()
+        fut: asyncio.Future = loop.create_future()
+        if not batch:
+            await self._dispatch([(desc, fut)])
+            return await fut
+        # Used outside the app lifespan, the collector died, or this is a new loop (e.g.
+        # TestClient without `with`): the old queue and task can't serve this one
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self.start()
+        await self._queue.put((desc, fut))
+        return await fut
+
+    async def _run(self, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.wait_sec
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Send without blocking collection of the next batch
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    @staticmethod
+    async def _complete(user_msg: str) -> str:
+        resp = await _client.chat.completions.create(
+            model=_default_model(),
+            messages=[_SYSTEM_MSG, {"role": "user", "content": user_msg}],
+            temperature=0.0,
+        )
+        return resp.choices[0].message.content or ""
+
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        if len(batch) == 1:
+            desc, fut = batch[0]
+            user_msg = _cargo_user_msg(desc)
+            try:
+                raw = await self._complete(user_msg)
+                item = orjson.loads(raw)
+                if not isinstance(item, dict):
+                    raise ValueError("answer is not a JSON object")
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+                return
+            if not fut.done():
+                fut.set_result((user_msg, raw, item, 1))
+            return
+
+        user_msg = _cargo_batch_user_msg([desc for desc, _ in batch])
+        try:
+            raw = await self._complete(user_msg)
+        except Exception as e:
+            # Transport/API failure: nothing item-specific to salvage, callers retry
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        try:
+            answers = orjson.loads(raw)
+            # Entries that aren't objects are skipped and their items re-asked below
+            by_id = {str(a.get("id")): a for a in answers if isinstance(a, dict)}
+        except Exception:
+            by_id = {}  # unparsable as a whole: every item is re-asked on its own
+
+        redo = []
+        for i, (desc, fut) in enumerate(batch, start=1):
+            if fut.done():
+                continue
+            item = by_id.get(str(i))
+            if isinstance(item, dict):
+                own_msg = orjson.dumps({"id": str(i), "desc": desc}).decode()
+                fut.set_result((own_msg, orjson.dumps(item).decode(), item, len(batch)))
+            else:
+                redo.append((desc, fut))
+        if redo:
+            await asyncio.gather(*(self._dispatch([entry]) for entry in redo))
+
+_batcher = CargoBatcher(CARGO_BATCH_MAX, CARGO_BATCH_WAIT_MS)
+
+# Only "ok" results of single-item requests are cached: errors and uncertain answers
+# must stay retryable.
+_CLASSIFY_CACHE: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+
+# An answer is only valid for the model and prompts that produced it: keys are salted
+# with both, so changing the model URI or CARGO_CLASSES starts from an empty cache.
+_CLASSIFY_KEY_BASE = hashlib.blake2b(digest_size=8)
+_CLASSIFY_KEY_BASE.update("\n".join([
+    _default_model() or "",
+    _SYSTEM_MSG["content"],
+    _cargo_user_msg(""),
+    _cargo_batch_user_msg([]),
+]).encode("utf-8"))
+
+def _classify_cache_key(desc: str) -> str:
+    h = _CLASSIFY_KEY_BASE.copy()
+    h.update(_normalize_desc(desc).encode("utf-8"))
+    return h.hexdigest()
+
+def _classify_cache_remember(key: str, cid: str, reason: str) -> None:
+    _CLASSIFY_CACHE[key] = (cid, reason)
+    _CLASSIFY_CACHE.move_to_end(key)
+    if len(_CLASSIFY_CACHE) > CLASSIFY_CACHE_SIZE:
+        _CLASSIFY_CACHE.popitem(last=False)
+
+async def _classify_cache_get(key: str) -> Optional[Tuple[str, str]]:
+    hit = _CLASSIFY_CACHE.get(key)
+    if hit is not None:
+        _CLASSIFY_CACHE.move_to_end(key)
+        return hit
+    if _redis is None:
+        return None
+    # Shared tier: survives restarts and is seen by every replica
+    try:
+        raw = await _redis_op(_redis.get("cls:" + key))
+        if not raw:
+            return None
+        cid, reason = msgpack.unpackb(raw)
+        if not isinstance(cid, str) or cid not in _CARGO_KEYS_SET or not isinstance(reason, str):
+            return None
+    except Exception:
+        return None  # Redis down, or a corrupt/legacy value: treat it as a miss
+    _classify_cache_remember(key, cid, reason)
+    return cid, reason
+
+async def _classify_cache_put(key: str, cid: str, reason: str) -> None:
+    _classify_cache_remember(key, cid, reason)
+    if _redis is None:
+        return
+    try:
+        value = msgpack.packb([cid, reason])
+        await _redis_op(_redis.set("cls:" + key, value, ex=CLASSIFY_CACHE_TTL_SEC))
+    except Exception:
+        pass  # cache write is best-effort; the result is already returned to the user
+
+# Delete a shared answer only while it still holds the rejected class. Values are
+# msgpack [cid, reason], so the packed 2-array header plus cid is an exact prefix.
+_FORGET_LUA = """
+local v = redis.call("get", KEYS[1])
+if v and string.sub(v, 1, #ARGV[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+async def _classify_cache_forget(desc: str, cid: str) -> None:
+    # The user rejected this answer: stop proposing it to everyone for the next 30 days.
+    # A rejected proposal of another class (e.g. from the keyword shortcut) keeps the entry.
+    # Other workers' process tiers keep their copy until it ages out of their LRU.
+    key = _classify_cache_key(desc)
+    hit = _CLASSIFY_CACHE.get(key)
+    if hit is not None and hit[0] == cid:
+        del _CLASSIFY_CACHE[key]
+    if _redis is None:
+        return
+    try:
+        prefix = b"\x92" + msgpack.packb(cid)
+        await _redis_op(_redis.eval(_FORGET_LUA, 1, "cls:" + key, prefix))
+    except Exception:
+        pass
+
 def _clip(s: str, n: int = DEBUG_MAX_TEXT) -> str:
     if s is None:
         return ""
@@ -102,19 +432,54 @@ def _clip(s: str, n: int = DEBUG_MAX_TEXT) -> str:
         return s
     return s[:n] + f"\n…(truncated, {len(s)} chars total)"
 
-def llm_classify_cargo_with_trace(
+def _build_trace(
+    attempt: int,
+    elapsed_ms: int,
+    model: str,
+    batch_size: Optional[int],
+    user_msg: str,
+    raw: str,
+    parsed_obj: Optional[Dict[str, Any]],
+    status: LLMStatus,
+    cid: Optional[str],
+    reason: str,
+    err_name: Optional[str],
+) -> Dict[str, Any]:
+    # Only called when tracing: the clipped prompt copies never happen otherwise
+    known = cid in _CARGO_KEYS_SET
+    return {
+        "kind": "cargo_classification",
+        "attempt": attempt,
+        "elapsed_ms": elapsed_ms,
+        "model": model,
+        "batch_size": batch_size,
+        "request": {
+            "messages": [
+                {"role": "system", "content": _clip(_SYSTEM_MSG["content"])},
+                {"role": "user", "content": _clip(user_msg)},
+            ]
+        },
+        "response_raw": _clip(raw),
+        "response_parsed": parsed_obj,
+        "status": status,
+        "cargo_class_id": cid if known else None,
+        "cargo_class_name": CARGO_CLASSES[cid] if known else None,
+        "reason": reason,
+        "error": err_name,
+    }
+
+async def llm_classify_cargo(
     desc: str,
-    debug_enabled: bool,
-    debug_trace: Dict[str, Any],
+    debug_trace: Optional[Dict[str, Any]] = None,
     max_attempts: int = LLM_ATTEMPTS_PER_TRY,
     base_delay_sec: float = LLM_BASE_DELAY_SEC,
 ) -> Tuple[Optional[str], LLMStatus, str]:
     """
-    Calls LLM and appends full request/response to debug_trace['llm_calls'] when debug_enabled.
+    Calls LLM and appends full request/response to debug_trace['llm_calls'] when a trace is given.
     Returns (cargo_class_id or None, status, reason). Never raises.
     """
     if not _client:
-        if debug_enabled:
+        if debug_trace is not None:
             debug_trace["llm_calls"].append({
                 "kind": "cargo_classification",
                 "status": "error",
@@ -124,47 +489,41 @@ def llm_classify_cargo_with_trace(
             })
         return None, "error", "LLM not configured"
 
-    system_msg = (
-        "Ты классификатор грузов для страхования грузоперевозок. "
-        "Тебе дано описание груза и белый список допустимых классов. "
-        "Верни строго JSON без лишнего текста. "
-        "Если не уверен или груз не подходит — верни cargo_class_id=null.\n\n"
-        f"Белый список (id -> name): {json.dumps(CARGO_CLASSES, ensure_ascii=False)}"
-    )
-    user_msg = (
-        f"Описание груза: {desc}\n"
-        "Верни JSON: {\"cargo_class_id\": string|null, \"confidence\": 0..1, \"reason\": string}"
-    )
-
-    messages = [
-        {"role": "system", "content": system_msg},
-        {"role": "user", "content": user_msg},
-    ]
+    cache_key = _classify_cache_key(desc)
+    cached = await _classify_cache_get(cache_key)
+    if cached is not None:
+        if debug_trace is not None:
+            debug_trace["notes"].append("cache_hit")
+        return cached[0], "ok", cached[1]
 
     last_reason = "unknown"
     last_uncertain_reason = "uncertain"
-    last_raw = ""
     model = _default_model()
+    status: LLMStatus = "error"
 
     for attempt in range(1, max_attempts + 1):
-        t0 = time.time()
+        t0 = time.monotonic_ns()
         err_name = None
         parsed_obj = None
         cid = None
-        status: LLMStatus = "error"
+        status = "error"
+        # The first attempt may share a request with other chats; retries go alone,
+        # so a description that trips up batched answers only costs us our own retries
+        batched = attempt == 1
+        # Per attempt, so a failed one doesn't report the previous call's prompt and size;
+        # a batched attempt that failed has no prompt entry of its own to show
+        user_msg = "" if batched else _cargo_user_msg(desc)
+        raw = ""
+        batch_size = None if batched else 1
 
         try:
-            resp = _client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.0,
-            )
-            last_raw = resp.choices[0].message.content or ""
-            # parse
-            parsed_obj = json.loads(last_raw)
+            async with asyncio.timeout(LLM_TIMEOUT_SEC):
+                user_msg, raw, parsed_obj, batch_size = await _batcher.submit(
+                    desc, batch=batched
+                )
             cid = parsed_obj.get("cargo_class_id")
             reason = parsed_obj.get("reason", "")
-            if cid in CARGO_CLASSES:
+            if cid in _CARGO_KEYS_SET:
                 status = "ok"
                 last_reason = reason
             else:
@@ -176,177 +535,544 @@ def llm_classify_cargo_with_trace(
             last_reason = f"LLM attempt {attempt} failed: {err_name}"
             status = "error"
 
-        elapsed_ms = int((time.time() - t0) * 1000)
+        elapsed_ms = (time.monotonic_ns() - t0) // 1_000_000
 
-        if debug_enabled:
-            debug_trace["llm_calls"].append({
-                "kind": "cargo_classification",
-                "attempt": attempt,
-                "elapsed_ms": elapsed_ms,
-                "model": model,
-                "request": {
-                    "messages": [
-                        {"role": "system", "content": _clip(system_msg)},
-                        {"role": "user", "content": _clip(user_msg)},
-                    ]
-                },
-                "response_raw": _clip(last_raw),
-                "response_parsed": parsed_obj,
-                "status": status,
-                "cargo_class_id": cid if cid in CARGO_CLASSES else None,
-                "cargo_class_name": CARGO_CLASSES.get(cid) if cid in CARGO_CLASSES else None,
-                "reason": last_reason,
-                "error": err_name,
-            })
+        if debug_trace is not None:
+            debug_trace["llm_calls"].append(_build_trace(
+                attempt, elapsed_ms, model, batch_size, user_msg, raw,
+                parsed_obj, status, cid, last_reason, err_name,
+            ))
 
-        if status == "ok" and cid in CARGO_CLASSES:
+        if status == "ok" and cid in _CARGO_KEYS_SET:
+            # A batched answer is shaped by the other descriptions in its prompt (one of
+            # them may be an injection), so only answers to our description alone are
+            # shared with everyone else who sends the same text
+            if batch_size == 1:
+                await _classify_cache_put(cache_key, cid, last_reason)
             return cid, "ok", last_reason
 
         # If uncertain, we can retry (sometimes output formatting is unstable)
         # If error, retry as well.
         if attempt < max_attempts:
-            time.sleep(base_delay_sec * attempt)
+            await asyncio.sleep(base_delay_sec * attempt)
 
-    # Final decision after attempts
-    # If last attempt was a real LLM error -> error, else uncertain
-    if "failed" in last_reason.lower() or "not configured" in last_reason.lower() or "attempt" in last_reason.lower():
+    # Final decision after attempts: the last attempt's status, error or uncertain
+    if status == "error":
         return None, "error", last_reason
     return None, "uncertain", last_uncertain_reason or last_reason
 
 # =========================
-# Session store (in-memory MVP)
+# Background cargo re-classification
 # =========================
-_SESSIONS: Dict[str, Dict[str, Any]] = {}
+# When classification fails the bot asks the user to wait and write again. The retry
+# starts right away instead, so by the next message its result is usually ready.
+# Process-local: a turn served by another worker just classifies inline.
+CARGO_PREFETCH_KEEP_SEC = 300  # a finished result waits this long for the user's next message
+
+_ClassifyResult = Tuple[Optional[str], LLMStatus, str]
+# session_id -> (description, task, its debug trace or None)
+_prefetch: Dict[str, Tuple[str, "asyncio.Task[_ClassifyResult]", Optional[Dict[str, Any]]]] = {}
+
+
+def _prefetch_drop(session_id: str, entry: Tuple[Any, ...]) -> None:
+    if _prefetch.get(session_id) is entry:
+        del _prefetch[session_id]
+
+
+def _prefetch_cancel(session_id: str) -> None:
+    entry = _prefetch.pop(session_id, None)
+    if entry is not None:
+        entry[1].cancel()
+
+
+def _prefetch_cancel_all() -> None:
+    for _, task, _ in _prefetch.values():
+        task.cancel()
+    _prefetch.clear()
+
+
+def _prefetch_start(session_id: str, desc: str, debug: bool) -> None:
+    # A newer description supersedes whatever was still running for this session
+    _prefetch_cancel(session_id)
+    trace: Optional[Dict[str, Any]] = {"llm_calls": [], "notes": []} if debug else None
+    task = asyncio.create_task(llm_classify_cargo(desc, trace))
+    entry = (desc, task, trace)
+    _prefetch[session_id] = entry
+    loop = asyncio.get_running_loop()
+    task.add_done_callback(
+        lambda _t: loop.call_later(CARGO_PREFETCH_KEEP_SEC, _prefetch_drop, session_id, entry)
+    )
+
+
+async def _prefetch_take(
+    session_id: str, desc: str, debug_trace: Optional[Dict[str, Any]]
+) -> Optional[Tuple[Optional[str], LLMStatus, str]]:
+    """
+    Result of the background classification of `desc` for this session, awaiting it if
+    still running; None when there is none (or it was for another description).
+    """
+    entry = _prefetch.pop(session_id, None)
+    if entry is None:
+        return None
+    pending_desc, task, trace = entry
+    if pending_desc != desc:
+        task.cancel()
+        return None
+    result = await task
+    if debug_trace is not None:
+        debug_trace["notes"].append("background classification")
+        if trace is not None:
+            debug_trace["llm_calls"].extend(trace["llm_calls"])
+            debug_trace["notes"].extend(trace["notes"])
+    return result
+
+# =========================
+# Session store (Redis, or in-memory MVP fallback)
+# =========================
+@dataclass(slots=True)
+class SessionData:
+    sum_insured_rub: Optional[int] = None
+    cargo_desc: Optional[str] = None
+    cargo_class_id: Optional[str] = None
+    condition: Optional[str] = None
+    franchise_rub: Optional[int] = None
+    is_reefer: Optional[bool] = None
+    route_zone: Optional[str] = None
+
+@dataclass(slots=True)
+class Pending:
+    cargo_proposed: Optional[Dict[str, str]] = None   # {"id": "...", "name": "..."}
+    cargo_retry_count: int = 0
+
+@dataclass(slots=True)
+class Session:
+    stage: str = "welcome"
+    intent: Optional[str] = None   # None | consult | buy
+    data: SessionData = field(default_factory=SessionData)
+    pending: Pending = field(default_factory=Pending)
+    expires_at: int = 0
 
 def _now() -> int:
+    # Wall-clock seconds: expires_at is persisted and compared across processes
     return int(time.time())
 
-def _clean_sessions():
-    t = _now()
-    dead = [k for k, v in _SESSIONS.items() if v.get("expires_at", 0) < t]
-    for k in dead:
-        _SESSIONS.pop(k, None)
+def _session_from_dict(raw: Dict[str, Any]) -> Session:
+    return Session(
+        stage=raw["stage"],
+        intent=raw["intent"],
+        data=SessionData(**raw["data"]),
+        pending=Pending(**raw["pending"]),
+        expires_at=raw["expires_at"],
+    )
 
-def _new_session() -> Dict[str, Any]:
-    return {
-        "stage": "welcome",
-        "intent": None,   # None | consult | buy
-        "data": {
-            "sum_insured_rub": None,
-            "cargo_desc": None,
-            "cargo_class_id": None,
-            "condition": None,
-            "franchise_rub": None,
-            "is_reefer": None,
-            "route_zone": None,
-        },
-        "pending": {
-            "cargo_proposed": None,   # {"id": "...", "name": "..."}
-            "cargo_retry_count": 0,
-        },
-        "expires_at": _now() + SESSION_TTL_SEC,
-    }
+def _state_key(s: Session) -> Tuple[Any, ...]:
+    # Everything save() persists except expires_at, as plain values for a cheap ==
+    d = s.data
+    p = s.pending
+    cp = p.cargo_proposed
+    return (
+        s.stage, s.intent,
+        d.sum_insured_rub, d.cargo_desc, d.cargo_class_id, d.condition,
+        d.franchise_rub, d.is_reefer, d.route_zone,
+        tuple(cp.items()) if cp else None, p.cargo_retry_count,
+    )
 
-def _get_session(session_id: str) -> Dict[str, Any]:
-    s = _SESSIONS.get(session_id)
-    if not s or s.get("expires_at", 0) < _now():
-        s = _new_session()
-        _SESSIONS[session_id] = s
-    s["expires_at"] = _now() + SESSION_TTL_SEC
-    return s
+class _LocalLocks:
+    """
+    One asyncio.Lock per session id, so turns of the same session run one at a
+    time while other sessions proceed. An entry lives only while a turn holds
+    or waits on it, which keeps the table bounded by in-flight requests.
+    """
+
+    def __init__(self) -> None:
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._users: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, session_id: str, timeout: float) -> AsyncIterator[None]:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        self._users[session_id] = self._users.get(session_id, 0) + 1
+        try:
+            try:
+                async with asyncio.timeout(timeout):
+                    await lock.acquire()
+            except TimeoutError:
+                raise _session_busy() from None
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            n = self._users[session_id] - 1
+            if n:
+                self._users[session_id] = n
+            else:
+                del self._users[session_id]
+                del self._locks[session_id]
+
+def _session_busy() -> HTTPException:
+    return HTTPException(
+        status_code=409, detail="Previous message of this session is still being processed"
+    )
+
+# Delete the lock only if it is still ours (it may have expired and been retaken)
+_UNLOCK_LUA = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+class SessionStore:
+    """
+    Redis-backed sessions: one msgpack blob per sess:<session_id> key, written
+    with EX=SESSION_TTL_SEC so Redis expires idle sessions by itself.
+    Any worker or replica can serve any session; lock() serializes turns of one
+    session across them with SET NX PX on sess:<session_id>:lock.
+    """
+
+    kind = "redis"
+
+    def __init__(self, client: redis.Redis) -> None:
+        self.client = client
+        self._local = _LocalLocks()
+        self._unlock = client.register_script(_UNLOCK_LUA)
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"sess:{session_id}"
+
+    async def get(self, session_id: str, now: Optional[int] = None) -> Session:
+        raw = await _redis_op(self.client.get(self._key(session_id)))
+        s = _session_from_dict(msgpack.unpackb(raw)) if raw else Session()
+        s.expires_at = (_now() if now is None else now) + SESSION_TTL_SEC
+        return s
+
+    async def save(self, session_id: str, s: Session) -> None:
+        # One SET carries both the new state and the TTL bump
+        value = msgpack.packb(asdict(s))
+        await _redis_op(self.client.set(self._key(session_id), value, ex=SESSION_TTL_SEC))
+
+    async def touch(self, session_id: str) -> None:
+        # Turn left the state as loaded: only the idle TTL needs renewing
+        await _redis_op(self.client.expire(self._key(session_id), SESSION_TTL_SEC))
+
+    @asynccontextmanager
+    async def lock(self, session_id: str) -> AsyncIterator[None]:
+        # Same-process turns queue on the local lock instead of polling Redis
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SESSION_LOCK_WAIT_MS / 1000
+        async with self._local.hold(session_id, SESSION_LOCK_WAIT_MS / 1000):
+            key = self._key(session_id) + ":lock"
+            token = os.urandom(8).hex()
+            while not await _redis_op(
+                self.client.set(key, token, nx=True, px=SESSION_LOCK_TTL_MS)
+            ):
+                if loop.time() >= deadline:
+                    raise _session_busy()
+                await asyncio.sleep(0.05)
+            try:
+                yield
+            finally:
+                # A failed unlock must not mask the turn's own outcome; the TTL frees the key
+                try:
+                    await _redis_op(self._unlock(keys=[key], args=[token]))
+                except Exception:
+                    log.warning("session %s: unlock failed", session_id, exc_info=True)
+
+    def count(self) -> Optional[int]:
+        return None
+
+class MemorySessionStore:
+    """
+    Process-local sessions for local runs and single-worker deployments.
+    Sessions are mutated in place, so save() is a no-op.
+    """
+
+    kind = "memory"
+
+    def __init__(self) -> None:
+        # Every touch renews the same TTL and moves the session to the end, so
+        # the dict stays ordered by expiry: the oldest entries are always first.
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._local = _LocalLocks()
+
+    async def get(self, session_id: str, now: Optional[int] = None) -> Session:
+        if now is None:
+            now = _now()
+        s = self._sessions.get(session_id)
+        if not s or s.expires_at < now:
+            s = Session()
+            self._sessions[session_id] = s
+            if len(self._sessions) > MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_id)
+        s.expires_at = now + SESSION_TTL_SEC
+        return s
+
+    async def save(self, session_id: str, s: Session) -> None:
+        return None
+
+    async def touch(self, session_id: str) -> None:
+        return None
+
+    def lock(self, session_id: str):
+        return self._local.hold(session_id, SESSION_LOCK_WAIT_MS / 1000)
+
+    def clean(self) -> None:
+        # Only pops what has actually expired, from the front
+        now = _now()
+        sessions = self._sessions
+        while sessions:
+            sid, s = next(iter(sessions.items()))
+            if s.expires_at >= now:
+                break
+            sessions.popitem(last=False)
+
+    def count(self) -> Optional[int]:
+        self.clean()
+        return len(self._sessions)
+
+_store = SessionStore(_redis) if _redis is not None else MemorySessionStore()
 
 # =========================
 # Parsing helpers
 # =========================
-def parse_sum_rub(text: str) -> Optional[int]:
-    t = text.lower().replace(",", ".")
-    m = re.search(r"(\d+(?:\.\d+)?)\s*(млн|миллион|million)", t)
+_RE_SUM_MLN = re.compile(r"(\d+(?:\.\d+)?)\s*(млн|миллион|million)")
+_RE_BIG_NUM = re.compile(r"\b(\d[\d\s]{5,})\b")
+_RE_WS = re.compile(r"\s+")
+_RE_DIGITS_1_2 = re.compile(r"\d{1,2}")
+_HAS_DIGIT = re.compile(r"\d").search
+_COMMA_TO_DOT = str.maketrans(",", ".")
+
+# Whole-message answers, checked with O(1) set membership
+_CONDITION_CODES: FrozenSet[str] = frozenset({"new", "used"})
+_FR_20000: FrozenSet[str] = frozenset({"20000", "20", "20к", "20 к", "20 тыс"})
+_FR_50000: FrozenSet[str] = frozenset({"50000", "50", "50к", "50 к", "50 тыс"})
+_YES: FrozenSet[str] = frozenset({"да", "yes", "y", "ок", "ага", "конечно", "верно", "правильно"})
+_NO: FrozenSet[str] = frozenset({"нет", "no", "n", "неа", "неверно"})
+_ROUTE_RF: FrozenSet[str] = frozenset({"rf", "russia", "россия", "рф"})
+
+# Keyword triggers -> tag. All of them are matched in one Aho-Corasick pass
+# over the lowercased message; parsers branch on the set of tags found.
+_KEYWORDS: Tuple[Tuple[str, str], ...] = (
+    ("б/у", "cond_used"),
+    ("бу", "cond_used"),
+    ("подерж", "cond_used"),
+    ("нов", "cond_new"),
+    ("франш", "franchise"),
+    ("франшиза", "franchise"),
+    ("фр", "franchise"),
+    ("20", "fr_20"),   # also covers "20000", "20к", "20 тыс"
+    ("50", "fr_50"),   # also covers "50000", "50к", "50 тыс"
+    ("без реф", "reefer_none"),
+    ("не", "neg"),
+    ("реф", "reefer"),
+    ("рефриж", "reefer"),
+    ("холод", "cold"),
+    ("снг", "route_cis"),
+    ("весь мир", "route_world"),
+    ("консул", "intent_consult"),
+    ("вопрос", "intent_consult"),
+    ("услов", "intent_consult"),
+    ("оформ", "intent_buy"),
+    ("страхов", "intent_buy"),
+    ("полис", "intent_buy"),
+    ("рассч", "intent_buy"),
+    ("куп", "intent_buy"),
+)
+
+_AC = ahocorasick.Automaton()
+for _kw, _tag in _KEYWORDS:
+    _AC.add_word(_kw, _tag)
+_AC.make_automaton()
+
+def _keyword_hits(tl: str) -> FrozenSet[str]:
+    return frozenset(tag for _, tag in _AC.iter(tl))
+
+# Whole descriptions that pin a cargo class without asking the LLM. The shortcut
+# only fires when the entire message is one of these phrases: any extra word
+# ("бензин для мотоциклов", "компьютерные столы", "молочная кислота") can change
+# eligibility or the class, and only the LLM checks that. Classes whose definition
+# hinges on a qualifier (hazard class, temperature regime) get no phrases at all.
+_CARGO_PHRASES: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("CARGO001", ("автомобиль", "автомобили", "легковые автомобили",
+                  "мотоцикл", "мотоциклы", "покрышки", "автопокрышки")),
+    ("CARGO002", ("бумага", "офисная бумага", "картон", "макулатура")),
+    ("CARGO003", ("микроволновка", "микроволновки", "микроволновые печи",
+                  "телевизор", "телевизоры", "ноутбук", "ноутбуки", "компьютер", "компьютеры",
+                  "смартфон", "смартфоны", "пылесос", "пылесосы", "принтер", "принтеры",
+                  "оргтехника")),
+    ("CARGO005", ("автозапчасти", "автокомпоненты")),
+    ("CARGO007", ("цемент", "кирпич", "гипсокартон", "стройматериалы",
+                  "строительные материалы", "ламинат")),
+    ("CARGO008", ("косметика", "парфюмерия", "шампунь", "шампуни")),
+    ("CARGO009", ("мебель", "диван", "диваны", "шкаф", "шкафы")),
+    ("CARGO010", ("одежда", "обувь")),
+    ("CARGO011", ("молоко", "мясо", "овощи", "фрукты", "крупы", "сахар", "консервы",
+                  "конфеты", "продукты питания")),
+    ("CARGO012", ("игрушки", "детские игрушки", "коляски", "детские коляски",
+                  "велосипед", "велосипеды", "тренажер", "тренажеры")),
+    ("CARGO013", ("станок", "станки", "станок чпу", "станки чпу", "конвейер")),
+    ("CARGO014", ("шприцы", "медтехника", "медицинские изделия", "томограф")),
+    ("CARGO015", ("металлопрокат", "металлоизделия", "арматура")),
+)
+_CARGO_SHORTCUTS: Dict[str, str] = {
+    phrase: cid for cid, phrases in _CARGO_PHRASES for phrase in phrases
+}
+_CARGO_TRIM = " .,!;"
+
+def _normalize_desc(desc: str) -> str:
+    # NFKC folds compatibility forms (full-width letters, ligatures, NBSP) before case/space
+    return _RE_WS.sub(" ", unicodedata.normalize("NFKC", desc).strip().lower())
+
+def cargo_keyword_match(tl: str) -> Optional[str]:
+    """Cargo class id when the whole message is a known phrase ("станок ЧПУ"), else None."""
+    return _CARGO_SHORTCUTS.get(_normalize_desc(tl).strip(_CARGO_TRIM).replace("ё", "е"))
+
+# Parsers take the turn's message twice: `tl` is stripped+lowercased once in
+# chat(), `raw` is the stripped original for the few checks that need case.
+# Keyword-based ones also accept the turn's precomputed `hits` to skip rescanning.
+def parse_sum_rub(tl: str, raw: str) -> Optional[int]:
+    # Both patterns need a digit; most turns ("да", cargo names) have none
+    if not _HAS_DIGIT(raw):
+        return None
+    m = _RE_SUM_MLN.search(tl.translate(_COMMA_TO_DOT))
     if m:
         val = float(m.group(1))
         return int(val * 1_000_000)
 
-    m2 = re.search(r"\b(\d[\d\s]{5,})\b", text)
+    m2 = _RE_BIG_NUM.search(raw)
     if m2:
         try:
-            return int(re.sub(r"\s+", "", m2.group(1)))
+            return int(_RE_WS.sub("", m2.group(1)))
         except Exception:
             return None
     return None
 
-def parse_condition(text: str) -> Optional[str]:
-    tl = text.lower().strip()
-    if "б/у" in tl or "бу" in tl or "подерж" in tl:
+def parse_condition(tl: str, raw: str, hits: Optional[FrozenSet[str]] = None) -> Optional[str]:
+    if hits is None:
+        hits = _keyword_hits(tl)
+    if "cond_used" in hits:
         return "USED"
-    if "нов" in tl:
+    if "cond_new" in hits:
         return "NEW"
-    if tl in ["new", "used"]:
+    if tl in _CONDITION_CODES:
         return tl.upper()
     return None
 
-def parse_franchise(text: str) -> Optional[int]:
-    tl = text.lower().strip()
-    if tl in ["20000", "20", "20к", "20 к", "20 тыс"]:
+def parse_franchise(tl: str, raw: str, hits: Optional[FrozenSet[str]] = None) -> Optional[int]:
+    if tl in _FR_20000:
         return 20000
-    if tl in ["50000", "50", "50к", "50 к", "50 тыс"]:
+    if tl in _FR_50000:
         return 50000
-    if ("франш" in tl or "франшиза" in tl or "фр" in tl) and any(x in tl for x in ["20", "20000", "20к", "20 тыс"]):
+    if hits is None:
+        hits = _keyword_hits(tl)
+    if "franchise" in hits and "fr_20" in hits:
         return 20000
-    if ("франш" in tl or "франшиза" in tl or "фр" in tl) and any(x in tl for x in ["50", "50000", "50к", "50 тыс"]):
+    if "franchise" in hits and "fr_50" in hits:
         return 50000
     return None
 
-def parse_yes_no(text: str) -> Optional[bool]:
-    tl = text.strip().lower()
-    if tl in ["да", "yes", "y", "ок", "ага", "конечно", "верно", "правильно"]:
+def parse_yes_no(tl: str, raw: str) -> Optional[bool]:
+    if tl in _YES:
         return True
-    if tl in ["нет", "no", "n", "неа", "неверно"]:
+    if tl in _NO:
         return False
     return None
 
-def parse_reefer(text: str) -> Optional[bool]:
-    tl = text.lower().strip()
-    yn = parse_yes_no(text)
+def parse_reefer(tl: str, raw: str, hits: Optional[FrozenSet[str]] = None) -> Optional[bool]:
+    yn = parse_yes_no(tl, raw)
     if yn is not None:
         return yn
-    if "без реф" in tl or ("не" in tl and ("реф" in tl or "рефриж" in tl)):
+    if hits is None:
+        hits = _keyword_hits(tl)
+    if "reefer_none" in hits or ("neg" in hits and "reefer" in hits):
         return False
-    if "реф" in tl or "рефриж" in tl or "холод" in tl:
+    if "reefer" in hits or "cold" in hits:
         return True
     return None
 
-def parse_route_zone(text: str) -> Optional[str]:
-    tl = text.lower().strip()
-    if "снг" in tl:
+def parse_route_zone(tl: str, raw: str, hits: Optional[FrozenSet[str]] = None) -> Optional[str]:
+    if hits is None:
+        hits = _keyword_hits(tl)
+    if "route_cis" in hits:
         return "СНГ-РФ"
-    if "весь мир" in tl:
+    if "route_world" in hits:
         return "ВЕСЬ МИР-РФ"
-    if tl in ["rf", "russia", "россия", "рф"]:
+    if tl in _ROUTE_RF:
         return "РФ"
-    if text.strip() in ROUTE_OPTIONS:
-        return text.strip()
+    if raw in _ROUTE_OPTIONS_SET:
+        return raw
     return None
 
-def parse_manual_cargo_choice(text: str) -> Optional[str]:
-    tl = text.strip().upper()
-    if tl in CARGO_CLASSES:
-        return tl
-    if re.fullmatch(r"\d{1,2}", text.strip()):
-        n = int(text.strip())
-        if 1 <= n <= len(CARGO_ORDER):
-            return CARGO_ORDER[n - 1]
+def parse_manual_cargo_choice(tl: str, raw: str) -> Optional[str]:
+    cid = raw.upper()
+    if cid in _CARGO_KEYS_SET:
+        return cid
+    if _RE_DIGITS_1_2.fullmatch(raw):
+        n = int(raw)
+        if 1 <= n <= len(_CARGO_KEYS):
+            return _CARGO_KEYS[n - 1]
     return None
 
+# The menu only depends on CARGO_CLASSES, so it is rendered once at import.
+_MANUAL_MENU_TEXT = "\n".join(
+    ["Не смог автоматически определить категорию. Выберите номер категории из списка:"]
+    + [f"{i}) {CARGO_CLASSES[cid]}" for i, cid in enumerate(_CARGO_KEYS, start=1)]
+    + ["Напишите номер (1–16)."]
+)
+
 def manual_cargo_choice_text() -> str:
-    lines = ["Не смог автоматически определить категорию. Выберите номер категории из списка:"]
-    for i, cid in enumerate(CARGO_ORDER, start=1):
-        lines.append(f"{i}) {CARGO_CLASSES[cid]}")
-    lines.append("Напишите номер (1–16).")
-    return "\n".join(lines)
+    return _MANUAL_MENU_TEXT
 
 # =========================
 # Tariff engine call
 # =========================
-def call_tariff_engine(payload: Dict[str, Any], debug_enabled: bool, debug_trace: Dict[str, Any]) -> Dict[str, Any]:
+# One pooled client for all turns: keep-alive reuses the TCP+TLS connection.
+# Transport retries cover connection failures; gateway statuses (cold container,
+# overloaded proxy) get one more try below, which is safe since /quote is a pure read.
+_TARIFF_RETRY_STATUSES = frozenset({502, 503, 504})
+_TARIFF_RETRY_BACKOFF_SEC = 0.2
+# Opened on first use, so the pool belongs to the serving event loop; closed by the lifespan
+_http: Optional[httpx.AsyncClient] = None
+_http_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def _new_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        # Short connect timeout: an unreachable engine fails the turn fast
+        timeout=httpx.Timeout(TARIFF_TIMEOUT_SEC, connect=2.0),
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            retries=2,
+        ),
+    )
+
+async def _close_tariff_client() -> None:
+    global _http
+    client, _http = _http, None
+    if client is not None:
+        try:
+            await client.aclose()
+        except Exception:
+            pass  # opened on a loop that is gone; dropping the pool is all that is left
+
+async def _tariff_client() -> httpx.AsyncClient:
+    # Also covers use outside the app lifespan (e.g. TestClient without `with`), where
+    # each request may run on a fresh loop that the old pool's connections can't serve
+    global _http, _http_loop
+    loop = asyncio.get_running_loop()
+    if _http is not None and _http_loop is not loop:
+        await _close_tariff_client()
+    if _http is None:
+        _http = _new_http_client()
+        _http_loop = loop
+    return _http
+
+async def call_tariff_engine(payload: Dict[str, Any], debug_trace: Optional[Dict[str, Any]]) -> Dict[str, Any]:
     if not TARIFF_URL:
         raise HTTPException(status_code=500, detail="TARIFF_URL is not set")
 
@@ -354,21 +1080,28 @@ def call_tariff_engine(payload: Dict[str, Any], debug_enabled: bool, debug_trace
     if TARIFF_BEARER:
         headers["Authorization"] = f"Bearer {TARIFF_BEARER}"
 
-    t0 = time.time()
+    t0 = time.monotonic_ns()
     try:
-        r = requests.post(TARIFF_URL, headers=headers, json=payload, timeout=15)
+        body = orjson.dumps(payload)
+        client = await _tariff_client()
+        # One deadline over both tries: httpx timeouts are per phase and per request
+        async with asyncio.timeout(TARIFF_TIMEOUT_SEC):
+            r = await client.post(TARIFF_URL, headers=headers, content=body)
+            if r.status_code in _TARIFF_RETRY_STATUSES:
+                await asyncio.sleep(_TARIFF_RETRY_BACKOFF_SEC)
+                r = await client.post(TARIFF_URL, headers=headers, content=body)
     except Exception as e:
-        if debug_enabled:
+        if debug_trace is not None:
             debug_trace["tariff_call"] = {
                 "request": payload,
                 "error": type(e).__name__,
-                "elapsed_ms": int((time.time() - t0) * 1000),
+                "elapsed_ms": (time.monotonic_ns() - t0) // 1_000_000,
             }
         raise HTTPException(status_code=502, detail=f"Tariff engine unreachable: {type(e).__name__}")
 
-    elapsed_ms = int((time.time() - t0) * 1000)
+    elapsed_ms = (time.monotonic_ns() - t0) // 1_000_000
     if r.status_code >= 400:
-        if debug_enabled:
+        if debug_trace is not None:
             debug_trace["tariff_call"] = {
                 "request": payload,
                 "status_code": r.status_code,
@@ -377,8 +1110,8 @@ def call_tariff_engine(payload: Dict[str, Any], debug_enabled: bool, debug_trace
             }
         raise HTTPException(status_code=502, detail=f"Tariff engine error: {r.status_code} {r.text}")
 
-    result = r.json()
-    if debug_enabled:
+    result = orjson.loads(r.content)
+    if debug_trace is not None:
         debug_trace["tariff_call"] = {
             "request": payload,
             "response": result,
@@ -394,6 +1127,9 @@ class ChatRequest(BaseModel):
     message: str = Field(..., min_length=1)
     debug: bool = False
 
+class ChatStartRequest(BaseModel):
+    session_id: str = Field(..., min_length=1)
+
 class ChatResponse(BaseModel):
     session_id: str
     reply: str
@@ -402,32 +1138,18 @@ class ChatResponse(BaseModel):
     data: Dict[str, Any]
     debug: Optional[Dict[str, Any]] = None
 
-# =========================
-# FastAPI app + CORS
-# =========================
-app = FastAPI(title="Insurance Dialog Service")
-
-origins = ["*"] if ALLOW_ORIGINS == "*" else [o.strip() for o in ALLOW_ORIGINS.split(",") if o.strip()]
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=False,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 @app.options("/chat")
 def chat_options():
     return Response(status_code=200)
 
 @app.get("/health")
 def health():
-    _clean_sessions()
     return {
         "status": "ok",
         "yandex_configured": bool(_client),
         "tariff_url_set": bool(TARIFF_URL),
-        "sessions": len(_SESSIONS),
+        "session_store": _store.kind,
+        "sessions": _store.count(),
         "allow_origins": origins,
         "model": _default_model(),
     }
@@ -442,281 +1164,487 @@ WELCOME_TEXT = (
     "Что выбираете: **консультация** или **оформить страховку**?"
 )
 
-def is_intent_consult(text: str) -> bool:
-    tl = text.lower()
-    return "консул" in tl or "вопрос" in tl or "услов" in tl
-
-def is_intent_buy(text: str) -> bool:
-    tl = text.lower()
-    return "оформ" in tl or "страхов" in tl or "полис" in tl or "рассч" in tl or "куп" in tl
+# Static replies, shared across turns
+_RPL_CONSULT_START = "Хорошо. Сформулируйте ваш вопрос по страхованию грузоперевозок — я отвечу."
+_RPL_INTENT_ASK = "Пожалуйста, напишите: **консультация** или **оформить страховку**."
+_RPL_CARGO_REASK = "Ок. Тогда уточните, пожалуйста, какой груз перевозите (1–2 слова)?"
+_RPL_CONFIRM_YESNO = "Подтвердите, пожалуйста: **да** или **нет**."
+_RPL_CARGO_NUM = "Пожалуйста, введите номер категории (1–16)."
+_RPL_SUM_RETRY = "Не понял сумму. Укажите, пожалуйста, например: 5 000 000 или 5 млн."
+_RPL_CONDITION_RETRY = "Укажите: NEW (новый) или USED (б/у)."
+_RPL_FRANCHISE_RETRY = "Выберите франшизу строго из списка: 20 000 ₽ или 50 000 ₽."
+_RPL_REEFER_RETRY = "Нужен рефрижератор? Ответьте: да или нет."
+_RPL_ROUTE_RETRY = "Выберите зону строго из списка: РФ / СНГ-РФ / ВЕСЬ МИР-РФ"
+_RPL_NEXT_PHASE = "Отлично. Следующий шаг — ввод контактных данных и выпуск полиса. Эту фазу подключим дальше."
+_RPL_RESTART = "Ок. Хотите консультацию или рассчитать другую перевозку? (консультация / оформить страховку)"
+_RPL_YESNO = "Ответьте, пожалуйста: да или нет."
+_RPL_HANDOFF = "Принято. (MVP) Передача менеджеру будет подключена следующим шагом."
+_RPL_FALLBACK = "Давайте начнём: вам нужна консультация или оформить страховку?"
+_RPL_CONSULT_INFO = (
+    "Понял вопрос. Сейчас я могу подсказать общий порядок и требования.\n"
+    "Если хотите — уточните: какой груз, какая сумма и зона перевозки.\n"
+    "Если нужно сразу рассчитать стоимость — напишите: **оформить страховку**."
+)
+_RPL_CARGO_RETRY_WAIT = (
+    "Секунду, уточняю категорию груза… сервис классификации временно отвечает нестабильно.\n"
+    "Подождите 5–10 секунд и отправьте любое сообщение (например, «ок»), я попробую ещё раз."
+)
+_RPL_CARGO_WAIT = (
+    "Секунду, уточняю категорию груза…\n"
+    "Подождите 5–10 секунд и отправьте любое сообщение (например, «ок»), я попробую ещё раз."
+)
 
-def quote_missing(data: Dict[str, Any]) -> list:
+def quote_missing(data: SessionData) -> list:
+    # Unrolled: plain slot reads instead of getattr over a key list
     miss = []
-    for k in ["sum_insured_rub", "cargo_class_id", "condition", "franchise_rub", "is_reefer", "route_zone"]:
-        if data.get(k) is None:
-            miss.append(k)
+    if data.sum_insured_rub is None:
+        miss.append("sum_insured_rub")
+    if data.cargo_class_id is None:
+        miss.append("cargo_class_id")
+    if data.condition is None:
+        miss.append("condition")
+    if data.franchise_rub is None:
+        miss.append("franchise_rub")
+    if data.is_reefer is None:
+        miss.append("is_reefer")
+    if data.route_zone is None:
+        miss.append("route_zone")
     return miss
 
-def next_question(stage: str) -> str:
-    if stage == "quote_sum":
-        return "Какая страховая сумма по перевозке (в рублях)? Например: 5 000 000 или 5 млн."
-    if stage == "quote_cargo":
-        return "Какой груз перевозите? Напишите одним-двумя словами (например: молоко, микроволновки, шприцы, станок ЧПУ)."
-    if stage == "quote_condition":
-        return "Груз новый или б/у? (NEW = новый, USED = б/у)"
-    if stage == "quote_franchise":
-        return "Выберите франшизу: 20 000 ₽ или 50 000 ₽?"
-    if stage == "quote_reefer":
-        return "Нужен рефрижератор? (да/нет)"
-    if stage == "quote_route":
-        return "Выберите зону маршрута: РФ / СНГ-РФ / ВЕСЬ МИР-РФ"
-    return "Уточните, пожалуйста."
+_NEXT_Q: Dict[str, str] = {
+    "quote_sum": "Какая страховая сумма по перевозке (в рублях)? Например: 5 000 000 или 5 млн.",
+    "quote_cargo": "Какой груз перевозите? Напишите одним-двумя словами (например: молоко, микроволновки, шприцы, станок ЧПУ).",
+    "quote_condition": "Груз новый или б/у? (NEW = новый, USED = б/у)",
+    "quote_franchise": "Выберите франшизу: 20 000 ₽ или 50 000 ₽?",
+    "quote_reefer": "Нужен рефрижератор? (да/нет)",
+    "quote_route": "Выберите зону маршрута: РФ / СНГ-РФ / ВЕСЬ МИР-РФ",
+}
+
+# Stage prompts with a fixed lead-in, joined once
+_RPL_BUY_START = "Отлично, оформим страховку. " + _NEXT_Q["quote_sum"]
+_RPL_CONSULT_TO_BUY = "Понял. Давайте оформим. " + _NEXT_Q["quote_sum"]
+_RPL_SUM_OK = "Спасибо. " + _NEXT_Q["quote_cargo"]
+_RPL_DATA_MISSING = "Не хватает данных для расчёта. " + _NEXT_Q["quote_sum"]
+# Per-category replies, one ready string per whitelist entry
+_RPL_CARGO_CONFIRM: Dict[str, str] = {
+    cid: f"Похоже, ваш груз относится к категории: «{name}». Верно? (да/нет)"
+    for cid, name in CARGO_CLASSES.items()
+}
+_RPL_CARGO_ACCEPTED: Dict[str, str] = {
+    cid: f"Принял категорию: «{name}».\n{_NEXT_Q['quote_condition']}"
+    for cid, name in CARGO_CLASSES.items()
+}
 
 # =========================
-# Main handler
+# Stage handlers
 # =========================
-@app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
-    s = _get_session(req.session_id)
-    data = s["data"]
-    pending = s["pending"]
+@dataclass(slots=True)
+class Turn:
+    session_id: str
+    s: Session
+    text: str
+    tl: str
+    hits: FrozenSet[str]  # keyword tags of tl, one automaton pass per turn
+    debug_trace: Optional[Dict[str, Any]]  # None unless the request asked for debug
+    before: Tuple[Any, ...]  # _state_key() as loaded, to skip writing an unchanged session
+
+
+def _chat_response(
+    session_id: str, s: Session, text: str, debug: Optional[Dict[str, Any]]
+) -> Dict[str, Any]:
+    # The ChatResponse body as a plain dict. Every field is server-generated, so the
+    # endpoints send it as an ORJSONResponse: FastAPI skips response_model validation and
+    # serialization for a returned Response, and the model only documents the schema.
+    return {
+        "session_id": session_id,
+        "reply": text,
+        "stage": s.stage,
+        "intent": s.intent,
+        "data": asdict(s.data),
+        "debug": debug,
+    }
+
+
+async def _stage_welcome(t: Turn) -> str:
+    t.s.stage = "intent_select"
+    return WELCOME_TEXT
+
+
+async def _stage_intent_select(t: Turn) -> str:
+    s = t.s
+    if "intent_consult" in t.hits:
+        s.intent = "consult"
+        s.stage = "consult"
+        return _RPL_CONSULT_START
+    if "intent_buy" in t.hits:
+        s.intent = "buy"
+        s.stage = "quote_sum"
+        return _RPL_BUY_START
+    return _RPL_INTENT_ASK
+
+
+async def _stage_consult(t: Turn) -> str:
+    # MVP placeholder; later RAG
+    s = t.s
+    if "intent_buy" in t.hits:
+        s.intent = "buy"
+        s.stage = "quote_sum"
+        return _RPL_CONSULT_TO_BUY
+    return _RPL_CONSULT_INFO
+
+
+# =========================
+# BUY FLOW
+# =========================
+async def _stage_cargo_confirm(t: Turn) -> str:
+    # confirm proposed cargo class
+    s = t.s
+    data = s.data
+    pending = s.pending
+    if not pending.cargo_proposed:
+        return await _stage_fallback(t)
+    yn = parse_yes_no(t.tl, t.text)
+    if yn is True:
+        data.cargo_class_id = pending.cargo_proposed["id"]
+        pending.cargo_proposed = None
+        s.stage = "quote_condition"
+        return _NEXT_Q["quote_condition"]
+    if yn is False:
+        if data.cargo_desc:
+            await _classify_cache_forget(data.cargo_desc, pending.cargo_proposed["id"])
+        pending.cargo_proposed = None
+        data.cargo_class_id = None
+        data.cargo_desc = None
+        s.stage = "quote_cargo"
+        return _RPL_CARGO_REASK
+    return _RPL_CONFIRM_YESNO
+
+
+async def _stage_cargo_retry(t: Turn) -> str:
+    # retry classification after user "waits"
+    s = t.s
+    pending = s.pending
+    pending.cargo_retry_count += 1
+    desc = s.data.cargo_desc or ""
+
+    # The user's message is only the "go on" signal; the retry itself is usually done by now
+    result = await _prefetch_take(t.session_id, desc, t.debug_trace)
+    if result is None:
+        result = await llm_classify_cargo(desc, t.debug_trace)
+    cid, status, reason = result
+    if status == "ok" and cid:
+        pending.cargo_proposed = {"id": cid, "name": CARGO_CLASSES[cid]}
+        s.stage = "cargo_confirm"
+        return _RPL_CARGO_CONFIRM[cid]
+
+    if status == "error" and pending.cargo_retry_count <= CARGO_RETRY_MAX:
+        _prefetch_start(t.session_id, desc, t.debug_trace is not None)
+        return _RPL_CARGO_RETRY_WAIT
+
+    s.stage = "cargo_choose"
+    return manual_cargo_choice_text()
+
+
+async def _stage_cargo_choose(t: Turn) -> str:
+    # manual selection
+    s = t.s
+    cid = parse_manual_cargo_choice(t.tl, t.text)
+    if cid:
+        s.data.cargo_class_id = cid
+        s.stage = "quote_condition"
+        return _RPL_CARGO_ACCEPTED[cid]
+    return _RPL_CARGO_NUM
+
+
+async def _stage_quote_sum(t: Turn) -> str:
+    s = t.s
+    val = parse_sum_rub(t.tl, t.text)
+    if val is None:
+        return _RPL_SUM_RETRY
+    s.data.sum_insured_rub = val
+    s.stage = "quote_cargo"
+    return _RPL_SUM_OK
+
+
+async def _stage_quote_cargo(t: Turn) -> str:
+    s = t.s
+    s.data.cargo_desc = t.text
+    pending = s.pending
+    pending.cargo_retry_count = 0
+    _prefetch_cancel(t.session_id)
+
+    # Obvious descriptions ("молоко", "покрышки") skip the LLM round-trip; the user still confirms
+    cid = cargo_keyword_match(t.tl)
+    if cid:
+        status = "ok"
+        if t.debug_trace is not None:
+            t.debug_trace["notes"].append(f"cargo keyword match: {cid}")
+    else:
+        cid, status, reason = await llm_classify_cargo(t.text, t.debug_trace)
+
+    if status == "ok" and cid:
+        pending.cargo_proposed = {"id": cid, "name": CARGO_CLASSES[cid]}
+        s.stage = "cargo_confirm"
+        return _RPL_CARGO_CONFIRM[cid]
+
+    if status == "error":
+        s.stage = "cargo_retry"
+        _prefetch_start(t.session_id, t.text, t.debug_trace is not None)
+        return _RPL_CARGO_WAIT
+
+    s.stage = "cargo_choose"
+    return manual_cargo_choice_text()
+
+
+async def _stage_quote_condition(t: Turn) -> str:
+    s = t.s
+    cond = parse_condition(t.tl, t.text, t.hits)
+    if cond is None:
+        return _RPL_CONDITION_RETRY
+    s.data.condition = cond
+    s.stage = "quote_franchise"
+    return _NEXT_Q["quote_franchise"]
+
+
+async def _stage_quote_franchise(t: Turn) -> str:
+    s = t.s
+    fr = parse_franchise(t.tl, t.text, t.hits)
+    if fr is None or fr not in FRANCHISE_OPTIONS:
+        return _RPL_FRANCHISE_RETRY
+    s.data.franchise_rub = fr
+    s.stage = "quote_reefer"
+    return _NEXT_Q["quote_reefer"]
+
+
+async def _stage_quote_reefer(t: Turn) -> str:
+    s = t.s
+    rr = parse_reefer(t.tl, t.text, t.hits)
+    if rr is None:
+        return _RPL_REEFER_RETRY
+    s.data.is_reefer = rr
+    s.stage = "quote_route"
+    return _NEXT_Q["quote_route"]
+
+
+async def _stage_quote_route(t: Turn) -> str:
+    # -> call tariff
+    s = t.s
+    data = s.data
+    rz = parse_route_zone(t.tl, t.text, t.hits)
+    if rz is None or rz not in ROUTE_OPTIONS:
+        return _RPL_ROUTE_RETRY
+    data.route_zone = rz
+
+    missing = quote_missing(data)
+    if missing:
+        s.stage = "quote_sum"
+        return _RPL_DATA_MISSING
+
+    payload = {
+        "cargo_class_id": data.cargo_class_id,
+        "sum_insured_rub": int(data.sum_insured_rub),
+        "condition": data.condition,
+        "franchise_rub": int(data.franchise_rub),
+        "is_reefer": bool(data.is_reefer),
+        "route_zone": data.route_zone,
+    }
+
+    result = await call_tariff_engine(payload, t.debug_trace)
+    decision = result.get("decision", "REFER")
+
+    if decision == "AUTO_OK":
+        premium = result.get("premium_rub")
+        s.stage = "quoted"
+        return f"Стоимость страховки: {premium} ₽.\nСогласны оформить? (да/нет)"
+
+    reasons = ", ".join(result.get("reasons", [])) or "нужна проверка"
+    s.stage = "refer"
+    return f"Онлайн-оформление недоступно: {reasons}. Хотите передать заявку менеджеру? (да/нет)"
+
+
+async def _stage_quoted(t: Turn) -> str:
+    s = t.s
+    yn = parse_yes_no(t.tl, t.text)
+    if yn is True:
+        s.stage = "next_phase"
+        return _RPL_NEXT_PHASE
+    if yn is False:
+        s.stage = "intent_select"
+        return _RPL_RESTART
+    return _RPL_YESNO
+
+
+async def _stage_refer(t: Turn) -> str:
+    s = t.s
+    yn = parse_yes_no(t.tl, t.text)
+    if yn is True:
+        s.stage = "handoff"
+        return _RPL_HANDOFF
+    if yn is False:
+        s.stage = "intent_select"
+        return _RPL_RESTART
+    return _RPL_YESNO
+
+
+async def _stage_fallback(t: Turn) -> str:
+    t.s.stage = "intent_select"
+    return _RPL_FALLBACK
+
+
+# Built once; chat() dispatches on the stage with a single dict lookup
+_STAGE_HANDLERS: Dict[str, Callable[[Turn], Awaitable[str]]] = {
+    "welcome": _stage_welcome,
+    "intent_select": _stage_intent_select,
+    "consult": _stage_consult,
+    "cargo_confirm": _stage_cargo_confirm,
+    "cargo_retry": _stage_cargo_retry,
+    "cargo_choose": _stage_cargo_choose,
+    "quote_sum": _stage_quote_sum,
+    "quote_cargo": _stage_quote_cargo,
+    "quote_condition": _stage_quote_condition,
+    "quote_franchise": _stage_quote_franchise,
+    "quote_reefer": _stage_quote_reefer,
+    "quote_route": _stage_quote_route,
+    "quoted": _stage_quoted,
+    "refer": _stage_refer,
+}
 
+# =========================
+# Main handler
+# =========================
+async def _begin_turn(req: ChatRequest) -> Turn:
+    session_id = req.session_id
+    now = _now()  # the turn's single clock read, shared by the store and the trace
+    s = await _store.get(session_id, now)
     text = req.message.strip()
-    debug_enabled = bool(req.debug)
+    tl = text.lower()
 
-    # Per-turn debug trace (returned to widget only when debug=true)
+    # Per-turn debug trace, built only when the widget asked for it (debug=true)
+    if not req.debug:
+        return Turn(session_id, s, text, tl, _keyword_hits(tl), None, _state_key(s))
     debug_trace: Dict[str, Any] = {
         "turn": {
-            "session_id": req.session_id,
+            "session_id": session_id,
             "incoming_message": text,
-            "time_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "time_utc": datetime.fromtimestamp(now, _UTC).isoformat().replace("+00:00", "Z"),
         },
         "session_before": {
-            "stage": s.get("stage"),
-            "intent": s.get("intent"),
-            "data": data.copy(),
-            "pending": {
-                "cargo_proposed": pending.get("cargo_proposed"),
-                "cargo_retry_count": pending.get("cargo_retry_count"),
-            },
+            "stage": s.stage,
+            "intent": s.intent,
+            "data": asdict(s.data),
+            "pending": asdict(s.pending),
         },
         "llm_calls": [],
         "tariff_call": None,
         "notes": [],
     }
-
-    def respond(reply: str) -> ChatResponse:
-        # attach session_after snapshot
-        if debug_enabled:
-            debug_trace["session_after"] = {
-                "stage": s.get("stage"),
-                "intent": s.get("intent"),
-                "data": data.copy(),
-                "pending": {
-                    "cargo_proposed": pending.get("cargo_proposed"),
-                    "cargo_retry_count": pending.get("cargo_retry_count"),
-                },
+    return Turn(session_id, s, text, tl, _keyword_hits(tl), debug_trace, _state_key(s))
+
+
+async def _end_turn(t: Turn, reply: str) -> Dict[str, Any]:
+    s = t.s
+    changed = _state_key(s) != t.before
+    # attach session_after snapshot; an unchanged session shares the "before" one
+    if t.debug_trace is not None:
+        if changed:
+            t.debug_trace["session_after"] = {
+                "stage": s.stage,
+                "intent": s.intent,
+                "data": asdict(s.data),
+                "pending": asdict(s.pending),
             }
-        return ChatResponse(
-            session_id=req.session_id,
-            reply=reply,
-            stage=s.get("stage"),
-            intent=s.get("intent"),
-            data=data,
-            debug=debug_trace if debug_enabled else None,
-        )
+        else:
+            t.debug_trace["session_after"] = t.debug_trace["session_before"]
+    if changed:
+        await _store.save(t.session_id, s)
+    else:
+        await _store.touch(t.session_id)
+    return _chat_response(t.session_id, s, reply, t.debug_trace)
 
-    # 1) Welcome -> intent_select
-    if s["stage"] == "welcome":
-        s["stage"] = "intent_select"
-        return respond(WELCOME_TEXT)
-
-    # 2) Intent selection
-    if s["stage"] == "intent_select":
-        if is_intent_consult(text):
-            s["intent"] = "consult"
-            s["stage"] = "consult"
-            return respond("Хорошо. Сформулируйте ваш вопрос по страхованию грузоперевозок — я отвечу.")
-        if is_intent_buy(text):
-            s["intent"] = "buy"
-            s["stage"] = "quote_sum"
-            return respond("Отлично, оформим страховку. " + next_question("quote_sum"))
-        return respond("Пожалуйста, напишите: **консультация** или **оформить страховку**.")
-
-    # 3) Consult mode (MVP placeholder; later RAG)
-    if s["stage"] == "consult":
-        if is_intent_buy(text):
-            s["intent"] = "buy"
-            s["stage"] = "quote_sum"
-            return respond("Понял. Давайте оформим. " + next_question("quote_sum"))
-        return respond(
-            "Понял вопрос. Сейчас я могу подсказать общий порядок и требования.\n"
-            "Если хотите — уточните: какой груз, какая сумма и зона перевозки.\n"
-            "Если нужно сразу рассчитать стоимость — напишите: **оформить страховку**."
-        )
 
-    # =========================
-    # BUY FLOW
-    # =========================
-
-    # cargo_confirm: confirm proposed cargo class
-    if s["stage"] == "cargo_confirm" and pending.get("cargo_proposed"):
-        yn = parse_yes_no(text)
-        if yn is True:
-            data["cargo_class_id"] = pending["cargo_proposed"]["id"]
-            pending["cargo_proposed"] = None
-            s["stage"] = "quote_condition"
-            return respond(next_question("quote_condition"))
-        if yn is False:
-            pending["cargo_proposed"] = None
-            data["cargo_class_id"] = None
-            data["cargo_desc"] = None
-            s["stage"] = "quote_cargo"
-            return respond("Ок. Тогда уточните, пожалуйста, какой груз перевозите (1–2 слова)?")
-        return respond("Подтвердите, пожалуйста: **да** или **нет**.")
-
-    # cargo_retry: retry classification after user "waits"
-    if s["stage"] == "cargo_retry":
-        pending["cargo_retry_count"] = int(pending.get("cargo_retry_count", 0)) + 1
-        desc = data.get("cargo_desc") or ""
-
-        cid, status, reason = llm_classify_cargo_with_trace(desc, debug_enabled, debug_trace)
-        if status == "ok" and cid:
-            pending["cargo_proposed"] = {"id": cid, "name": CARGO_CLASSES[cid]}
-            s["stage"] = "cargo_confirm"
-            return respond(f"Похоже, ваш груз относится к категории: «{CARGO_CLASSES[cid]}». Верно? (да/нет)")
-
-        if status == "error" and pending["cargo_retry_count"] <= CARGO_RETRY_MAX:
-            return respond(
-                "Секунду, уточняю категорию груза… сервис классификации временно отвечает нестабильно.\n"
-                "Подождите 5–10 секунд и отправьте любое сообщение (например, «ок»), я попробую ещё раз."
-            )
-
-        s["stage"] = "cargo_choose"
-        return respond(manual_cargo_choice_text())
-
-    # cargo_choose: manual selection
-    if s["stage"] == "cargo_choose":
-        cid = parse_manual_cargo_choice(text)
-        if cid:
-            data["cargo_class_id"] = cid
-            s["stage"] = "quote_condition"
-            return respond(f"Принял категорию: «{CARGO_CLASSES[cid]}».\n{next_question('quote_condition')}")
-        return respond("Пожалуйста, введите номер категории (1–16).")
-
-    # quote_sum
-    if s["stage"] == "quote_sum":
-        val = parse_sum_rub(text)
-        if val is None:
-            return respond("Не понял сумму. Укажите, пожалуйста, например: 5 000 000 или 5 млн.")
-        data["sum_insured_rub"] = val
-        s["stage"] = "quote_cargo"
-        return respond("Спасибо. " + next_question("quote_cargo"))
-
-    # quote_cargo
-    if s["stage"] == "quote_cargo":
-        data["cargo_desc"] = text
-        pending["cargo_retry_count"] = 0
-
-        cid, status, reason = llm_classify_cargo_with_trace(text, debug_enabled, debug_trace)
-
-        if status == "ok" and cid:
-            pending["cargo_proposed"] = {"id": cid, "name": CARGO_CLASSES[cid]}
-            s["stage"] = "cargo_confirm"
-            return respond(f"Похоже, ваш груз относится к категории: «{CARGO_CLASSES[cid]}». Верно? (да/нет)")
-
-        if status == "error":
-            s["stage"] = "cargo_retry"
-            return respond(
-                "Секунду, уточняю категорию груза…\n"
-                "Подождите 5–10 секунд и отправьте любое сообщение (например, «ок»), я попробую ещё раз."
-            )
-
-        s["stage"] = "cargo_choose"
-        return respond(manual_cargo_choice_text())
-
-    # quote_condition
-    if s["stage"] == "quote_condition":
-        cond = parse_condition(text)
-        if cond is None:
-            return respond("Укажите: NEW (новый) или USED (б/у).")
-        data["condition"] = cond
-        s["stage"] = "quote_franchise"
-        return respond(next_question("quote_franchise"))
-
-    # quote_franchise
-    if s["stage"] == "quote_franchise":
-        fr = parse_franchise(text)
-        if fr is None or fr not in FRANCHISE_OPTIONS:
-            return respond("Выберите франшизу строго из списка: 20 000 ₽ или 50 000 ₽.")
-        data["franchise_rub"] = fr
-        s["stage"] = "quote_reefer"
-        return respond(next_question("quote_reefer"))
-
-    # quote_reefer
-    if s["stage"] == "quote_reefer":
-        rr = parse_reefer(text)
-        if rr is None:
-            return respond("Нужен рефрижератор? Ответьте: да или нет.")
-        data["is_reefer"] = rr
-        s["stage"] = "quote_route"
-        return respond(next_question("quote_route"))
-
-    # quote_route -> call tariff
-    if s["stage"] == "quote_route":
-        rz = parse_route_zone(text)
-        if rz is None or rz not in ROUTE_OPTIONS:
-            return respond("Выберите зону строго из списка: РФ / СНГ-РФ / ВЕСЬ МИР-РФ")
-        data["route_zone"] = rz
-
-        missing = quote_missing(data)
-        if missing:
-            s["stage"] = "quote_sum"
-            return respond("Не хватает данных для расчёта. " + next_question("quote_sum"))
-
-        payload = {
-            "cargo_class_id": data["cargo_class_id"],
-            "sum_insured_rub": int(data["sum_insured_rub"]),
-            "condition": data["condition"],
-            "franchise_rub": int(data["franchise_rub"]),
-            "is_reefer": bool(data["is_reefer"]),
-            "route_zone": data["route_zone"],
-        }
+@app.post("/chat", response_model=ChatResponse)
+async def chat(req: ChatRequest):
+    # One turn per session at a time: a double-sent message must not race on the stage
+    async with _store.lock(req.session_id):
+        t = await _begin_turn(req)
+        handler = _STAGE_HANDLERS.get(t.s.stage, _stage_fallback)
+        reply = await handler(t)
+        return ORJSONResponse(await _end_turn(t, reply))
+
+
+@app.options("/chat/start")
+def chat_start_options():
+    return Response(status_code=200)
+
+@app.post("/chat/start", response_model=ChatResponse)
+async def chat_start(req: ChatStartRequest):
+    """
+    Opens (or restarts) a conversation without a user message: returns the welcome
+    and leaves the session at intent_select, so the first /chat is already the answer.
+    POST, since it wipes the session: prefetchers and caches replay GETs.
+    """
+    session_id = req.session_id
+    async with _store.lock(session_id):
+        _prefetch_cancel(session_id)
+        s = await _store.get(session_id)
+        s.stage = "intent_select"
+        s.intent = None
+        s.data = SessionData()
+        s.pending = Pending()
+        await _store.save(session_id, s)
+        return ORJSONResponse(_chat_response(session_id, s, WELCOME_TEXT, None))
+
+
+def _stream_status(t: Turn) -> Optional[str]:
+    # Announced to stream clients only when the handler is about to wait on the LLM
+    if _client is None:
+        return None
+    stage = t.s.stage
+    if stage == "quote_cargo":
+        return None if cargo_keyword_match(t.tl) else "cargo_classifying"
+    if stage == "cargo_retry":
+        entry = _prefetch.get(t.session_id)
+        if entry is not None and entry[1].done() and entry[0] == (t.s.data.cargo_desc or ""):
+            return None  # the background retry already has the answer
+        return "cargo_classifying"
+    return None
+
+def _sse(event: str, payload: Any) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(payload) + b"\n\n"
 
-        result = call_tariff_engine(payload, debug_enabled, debug_trace)
-        decision = result.get("decision", "REFER")
-
-        if decision == "AUTO_OK":
-            premium = result.get("premium_rub")
-            s["stage"] = "quoted"
-            return respond(f"Стоимость страховки: {premium} ₽.\nСогласны оформить? (да/нет)")
-
-        reasons = ", ".join(result.get("reasons", [])) or "нужна проверка"
-        s["stage"] = "refer"
-        return respond(f"Онлайн-оформление недоступно: {reasons}. Хотите передать заявку менеджеру? (да/нет)")
-
-    # quoted
-    if s["stage"] == "quoted":
-        yn = parse_yes_no(text)
-        if yn is True:
-            s["stage"] = "next_phase"
-            return respond("Отлично. Следующий шаг — ввод контактных данных и выпуск полиса. Эту фазу подключим дальше.")
-        if yn is False:
-            s["stage"] = "intent_select"
-            return respond("Ок. Хотите консультацию или рассчитать другую перевозку? (консультация / оформить страховку)")
-        return respond("Ответьте, пожалуйста: да или нет.")
-
-    # refer
-    if s["stage"] == "refer":
-        yn = parse_yes_no(text)
-        if yn is True:
-            s["stage"] = "handoff"
-            return respond("Принято. (MVP) Передача менеджеру будет подключена следующим шагом.")
-        if yn is False:
-            s["stage"] = "intent_select"
-            return respond("Ок. Хотите консультацию или рассчитать другую перевозку? (консультация / оформить страховку)")
-        return respond("Ответьте, пожалуйста: да или нет.")
-
-    # fallback
-    s["stage"] = "intent_select"
-    return respond("Давайте начнём: вам нужна консультация или оформить страховку?")
\ No newline at end of file
+@app.options("/chat/stream")
+def chat_stream_options():
+    return Response(status_code=200)
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest):
+    """
+    Same turn as /chat, sent as Server-Sent Events:
+    an optional `status` event before the cargo LLM call, then one `reply` event
+    carrying the ChatResponse body, or one `error` event with the status_code and
+    detail /chat would have answered with.
+    """
+    async def events():
+        # The 200 is already sent once the stream starts, so failures go out as an event
+        try:
+            async with _store.lock(req.session_id):
+                t = await _begin_turn(req)
+                status = _stream_status(t)
+                if status:
+                    yield _sse("status", {"stage": status})
+                handler = _STAGE_HANDLERS.get(t.s.stage, _stage_fallback)
+                reply = await handler(t)
+                body = await _end_turn(t, reply)
+        except HTTPException as e:
+            yield _sse("error", {"status_code": e.status_code, "detail": e.detail})
+            return
+        except Exception:
+            yield _sse("error", {"status_code": 500, "detail": "Internal Server Error"})
+            return
+        yield _sse("reply", body)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
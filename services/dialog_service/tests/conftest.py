@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Tests import the service the way the container does: `app` from the service root
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
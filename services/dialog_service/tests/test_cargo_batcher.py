@@ -0,0 +1,194 @@
+"""
+Tests for CargoBatcher: one LLM request per batch, answers fanned back per chat,
+and members a batched answer drops or garbles re-asked on their own.
+
+The LLM round-trip (CargoBatcher._complete) is replaced by a scripted fake that
+answers from the prompt it is given; everything above it runs for real.
+"""
+from __future__ import annotations
+
+import asyncio
+
+import orjson
+import pytest
+from app import main
+
+CLASSES = {"молоко": "CARGO011", "микроволновки": "CARGO003", "станок": "CARGO013"}
+
+
+class FakeLLM:
+    """Answers every description from CLASSES; `batch_answer` can rewrite batched replies."""
+
+    def __init__(self, batch_answer=None, solo_answer=None):
+        self.prompts: list[str] = []
+        self.batch_answer = batch_answer
+        self.solo_answer = solo_answer
+
+    @staticmethod
+    def _item(desc: str) -> dict:
+        return {"cargo_class_id": CLASSES.get(desc), "confidence": 0.9, "reason": "r:" + desc}
+
+    async def __call__(self, user_msg: str) -> str:
+        self.prompts.append(user_msg)
+        head = user_msg.split("\n", 1)[0]
+        if head.startswith("Описание груза: "):
+            desc = head.removeprefix("Описание груза: ")
+            if self.solo_answer is not None:
+                return await self.solo_answer(desc)
+            return orjson.dumps(self._item(desc)).decode()
+        items = orjson.loads(head.removeprefix("Описания грузов: "))
+        answer = [dict(self._item(it["desc"]), id=it["id"]) for it in items]
+        if self.batch_answer is not None:
+            return self.batch_answer(answer)
+        return orjson.dumps(answer).decode()
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    def install(**kw) -> FakeLLM:
+        fake = FakeLLM(**kw)
+        monkeypatch.setattr(main.CargoBatcher, "_complete", staticmethod(fake))
+        return fake
+    return install
+
+
+async def _submit_all(batcher: main.CargoBatcher, descs, timeout: float = 1.0):
+    batcher.start()
+    try:
+        async def one(desc):
+            async with asyncio.timeout(timeout):
+                return await batcher.submit(desc)
+        return await asyncio.gather(*(one(d) for d in descs), return_exceptions=True)
+    finally:
+        await batcher.stop()
+
+
+def test_concurrent_descriptions_share_one_request(fake_llm):
+    fake = fake_llm()
+    descs = list(CLASSES)
+    results = asyncio.run(_submit_all(main.CargoBatcher(8, 50), descs))
+    assert len(fake.prompts) == 1
+    for desc, (user_msg, raw, item, batch_size) in zip(descs, results):
+        assert item["cargo_class_id"] == CLASSES[desc]
+        assert batch_size == len(descs)
+        # Each chat sees its own entry of the shared prompt and answer, nobody else's
+        others = [d for d in descs if d != desc]
+        assert desc in user_msg and not any(d in user_msg or d in raw for d in others)
+
+
+def test_dropped_and_garbled_members_are_reasked_alone(fake_llm):
+    def drop_and_garble(answer):
+        answer[1]["id"] = "99"   # unknown id: the second item is effectively missing
+        answer[2] = "garbled"    # not an object
+        return orjson.dumps(answer).decode()
+
+    fake = fake_llm(batch_answer=drop_and_garble)
+    descs = list(CLASSES)
+    results = asyncio.run(_submit_all(main.CargoBatcher(8, 50), descs))
+    assert [r[2]["cargo_class_id"] for r in results] == [CLASSES[d] for d in descs]
+    assert [r[3] for r in results] == [3, 1, 1]
+    assert len(fake.prompts) == 3
+
+
+def test_unparsable_batch_answer_reasks_every_member(fake_llm):
+    fake = fake_llm(batch_answer=lambda answer: "not json")
+    descs = list(CLASSES)
+    results = asyncio.run(_submit_all(main.CargoBatcher(8, 50), descs))
+    assert [r[2]["cargo_class_id"] for r in results] == [CLASSES[d] for d in descs]
+    assert len(fake.prompts) == 1 + len(descs)
+
+
+def test_transport_error_fails_the_whole_batch(fake_llm):
+    def fail(answer):
+        raise ConnectionError("LLM down")
+
+    fake_llm(batch_answer=fail)
+    results = asyncio.run(_submit_all(main.CargoBatcher(8, 50), list(CLASSES)))
+    assert all(isinstance(r, ConnectionError) for r in results)
+
+
+def test_timed_out_member_does_not_hold_up_the_others(fake_llm):
+    async def hang_on_moloko(desc):
+        if desc == "молоко":
+            await asyncio.sleep(1)  # past the caller's deadline; the SDK timeout ends it
+        return orjson.dumps(FakeLLM._item(desc)).decode()
+
+    def drop_first(answer):
+        return orjson.dumps(answer[1:]).decode()
+
+    fake_llm(batch_answer=drop_first, solo_answer=hang_on_moloko)
+    descs = list(CLASSES)  # "молоко" is id 1: missing from the batch answer and then hangs
+    results = asyncio.run(_submit_all(main.CargoBatcher(8, 50), descs, timeout=0.3))
+    assert isinstance(results[0], TimeoutError)
+    assert [r[2]["cargo_class_id"] for r in results[1:]] == [CLASSES[d] for d in descs[1:]]
+
+
+def test_batcher_follows_a_new_event_loop(fake_llm):
+    # No lifespan, and the first loop is left behind with the collector still pending on
+    # it, as with TestClient without `with`
+    fake_llm()
+    batcher = main.CargoBatcher(8, 10)
+    old_loop = asyncio.new_event_loop()
+    try:
+        first = old_loop.run_until_complete(batcher.submit("молоко"))
+        old_task = batcher._task
+        assert first[2]["cargo_class_id"] == "CARGO011"
+        second = asyncio.run(asyncio.wait_for(batcher.submit("станок"), 1))
+        assert second[2]["cargo_class_id"] == "CARGO013"
+    finally:
+        old_task.cancel()
+        old_loop.run_until_complete(asyncio.gather(old_task, return_exceptions=True))
+        old_loop.close()
+
+
+def test_debug_trace_shows_only_own_description(fake_llm, monkeypatch):
+    fake = fake_llm()
+    monkeypatch.setattr(main, "_client", object())  # "configured"; _complete is faked
+    monkeypatch.setattr(main, "_batcher", main.CargoBatcher(8, 50))
+    main._CLASSIFY_CACHE.clear()
+
+    async def run():
+        main._batcher.start()
+        try:
+            traces = [{"llm_calls": [], "notes": []} for _ in CLASSES]
+            results = await asyncio.gather(*(
+                main.llm_classify_cargo(desc, trace) for desc, trace in zip(CLASSES, traces)
+            ))
+            return results, traces
+        finally:
+            await main._batcher.stop()
+
+    results, traces = asyncio.run(run())
+    main._CLASSIFY_CACHE.clear()
+    assert len(fake.prompts) == 1
+    assert [r[0] for r in results] == list(CLASSES.values())
+    for desc, trace in zip(CLASSES, traces):
+        (call,) = trace["llm_calls"]
+        dumped = orjson.dumps(call).decode()
+        assert call["batch_size"] == len(CLASSES) and desc in dumped
+        assert not any(d in dumped for d in CLASSES if d != desc)
+
+
+def test_failed_retry_traces_its_own_call(monkeypatch):
+    monkeypatch.setattr(main, "_client", object())
+    main._CLASSIFY_CACHE.clear()
+    answers = iter([
+        ("batched entry", '{"cargo_class_id": null}', {"cargo_class_id": None}, 3),
+        ConnectionError("LLM down"),
+    ])
+
+    async def submit(desc, batch=True):
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(main._batcher, "submit", submit)
+    trace = {"llm_calls": [], "notes": []}
+    result = asyncio.run(main.llm_classify_cargo("карандаши", trace, 2, 0))
+    assert result == (None, "error", "LLM attempt 2 failed: ConnectionError")
+    first, second = trace["llm_calls"]
+    assert (first["batch_size"], first["status"]) == (3, "uncertain")
+    assert (second["batch_size"], second["error"]) == (1, "ConnectionError")
+    assert second["request"]["messages"][1]["content"] == main._cargo_user_msg("карандаши")
+    assert second["response_raw"] == ""
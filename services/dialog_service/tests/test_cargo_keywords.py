@@ -0,0 +1,45 @@
+"""
+The cargo keyword shortcut skips the LLM, so it must only fire on descriptions
+that cannot mean anything else: a modifier can change the class or eligibility.
+"""
+from __future__ import annotations
+
+import pytest
+from app.main import cargo_keyword_match
+
+
+@pytest.mark.parametrize("message,cid", [
+    ("молоко", "CARGO011"),
+    ("Микроволновки", "CARGO003"),
+    ("станок ЧПУ", "CARGO013"),
+    ("  покрышки. ", "CARGO001"),
+    ("тренажёры", "CARGO012"),
+    ("ШПРИЦЫ!", "CARGO014"),
+])
+def test_plain_descriptions_match(message, cid):
+    assert cargo_keyword_match(message.strip().lower()) == cid
+
+
+@pytest.mark.parametrize("message", [
+    # hazardous goods named after what they are for
+    "бензин для мотоциклов",
+    "пропан для автомобилей",
+    "антифриз для автомобилей",
+    "аккумуляторы для автомобилей",
+    "газовые баллоны для автомобилей",
+    "литиевые аккумуляторы для ноутбуков",
+    "лак для мебели",
+    "краска для мебели",
+    # a class word inside another word or phrase
+    "компьютерные столы",
+    "молочная кислота",
+    "овощерезка",
+    "конфетти",
+    # qualifiers the LLM has to weigh
+    "мясо замороженное",
+    "шкаф холодильный",
+    "шины",
+    "",
+])
+def test_anything_else_goes_to_the_llm(message):
+    assert cargo_keyword_match(message.lower()) is None
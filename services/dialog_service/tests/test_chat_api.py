@@ -0,0 +1,47 @@
+"""
+HTTP-level tests for the chat endpoints: the bodies they send, and that the
+ChatResponse schema is still published although responses bypass the model.
+"""
+from __future__ import annotations
+
+import pytest
+from app import main
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "_store", main.MemorySessionStore())
+    with TestClient(main.app) as c:
+        yield c
+
+
+def test_start_then_chat(client):
+    r = client.post("/chat/start", json={"session_id": "api"})
+    assert r.status_code == 200
+    assert r.json() == {
+        "session_id": "api",
+        "reply": main.WELCOME_TEXT,
+        "stage": "intent_select",
+        "intent": None,
+        "data": {k: None for k in main.SessionData.__slots__},
+        "debug": None,
+    }
+    r = client.post("/chat", json={"session_id": "api", "message": "оформить страховку"})
+    body = r.json()
+    assert (body["stage"], body["intent"], body["debug"]) == ("quote_sum", "buy", None)
+    assert set(body) == set(main.ChatResponse.model_fields)
+
+
+def test_start_rejects_get_and_empty_session(client):
+    assert client.get("/chat/start", params={"session_id": "api"}).status_code == 405
+    assert client.post("/chat/start", json={"session_id": ""}).status_code == 422
+
+
+def test_debug_body_and_schema(client):
+    r = client.post("/chat", json={"session_id": "dbg", "message": "привет", "debug": True})
+    assert r.json()["debug"]["session_after"]["stage"] == "intent_select"
+    schema = client.get("/openapi.json").json()
+    for path in ("/chat", "/chat/start"):
+        ok = schema["paths"][path]["post"]["responses"]["200"]["content"]["application/json"]
+        assert ok["schema"]["$ref"].endswith("/ChatResponse")
@@ -0,0 +1,63 @@
+"""
+Tests for the two-tier classification cache: what gets shared, and what a
+user's rejection removes. Redis is an in-process fakeredis instance.
+"""
+from __future__ import annotations
+
+import asyncio
+
+import fakeredis
+import msgpack
+import orjson
+import pytest
+from app import main
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    r = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(main, "_redis", r)
+    monkeypatch.setattr(main, "_client", object())  # "configured"; submit is faked
+    main._CLASSIFY_CACHE.clear()
+    yield r
+    main._CLASSIFY_CACHE.clear()
+
+
+def _fake_submit(monkeypatch, cid: str, batch_size: int) -> None:
+    async def submit(desc, batch=True):
+        item = {"cargo_class_id": cid, "reason": "r"}
+        return "msg", orjson.dumps(item).decode(), item, batch_size
+
+    monkeypatch.setattr(main._batcher, "submit", submit)
+
+
+def _stored(r, desc: str):
+    raw = asyncio.run(r.get("cls:" + main._classify_cache_key(desc)))
+    return msgpack.unpackb(raw) if raw else None
+
+
+def test_single_item_answer_is_shared(cache, monkeypatch):
+    _fake_submit(monkeypatch, "CARGO011", batch_size=1)
+    assert asyncio.run(main.llm_classify_cargo("молоко")) == ("CARGO011", "ok", "r")
+    assert _stored(cache, "молоко") == ["CARGO011", "r"]
+    assert main._CLASSIFY_CACHE
+
+
+def test_batched_answer_is_not_cached(cache, monkeypatch):
+    _fake_submit(monkeypatch, "CARGO011", batch_size=3)
+    assert asyncio.run(main.llm_classify_cargo("молоко")) == ("CARGO011", "ok", "r")
+    assert _stored(cache, "молоко") is None
+    assert not main._CLASSIFY_CACHE
+
+
+def test_rejection_forgets_only_the_rejected_class(cache):
+    asyncio.run(main._classify_cache_put(main._classify_cache_key("молоко"), "CARGO011", "r"))
+
+    # A rejected proposal of another class (the keyword shortcut, a stale worker) stays harmless
+    asyncio.run(main._classify_cache_forget("молоко", "CARGO001"))
+    assert _stored(cache, "молоко") == ["CARGO011", "r"]
+    assert main._CLASSIFY_CACHE
+
+    asyncio.run(main._classify_cache_forget("Молоко ", "CARGO011"))
+    assert _stored(cache, "молоко") is None
+    assert not main._CLASSIFY_CACHE
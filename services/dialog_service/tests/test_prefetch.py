@@ -0,0 +1,124 @@
+"""
+Tests for the background re-classification started when a cargo classification
+fails: it fills the cache, and the user's next message waits for it instead of
+asking the LLM again; without it the turn classifies inline.
+"""
+from __future__ import annotations
+
+import asyncio
+
+import orjson
+import pytest
+from app import main
+
+SID = "prefetch-test"
+
+
+class FlakyLLM:
+    """Fails the first `failures` calls, then answers CARGO012; `gate` can hold answers back."""
+
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.calls = 0
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def __call__(self, user_msg: str) -> str:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError("LLM down")
+        await self.gate.wait()
+        return orjson.dumps({"cargo_class_id": "CARGO012", "reason": "toys"}).decode()
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    def install(failures: int) -> FlakyLLM:
+        fake = FlakyLLM(failures)
+        monkeypatch.setattr(main.CargoBatcher, "_complete", staticmethod(fake))
+        return fake
+
+    monkeypatch.setattr(main, "_client", object())  # "configured"; _complete is faked
+    # Unbatched, so every classification is one counted LLM call
+    monkeypatch.setattr(main, "_batcher", main.CargoBatcher(1, 0))
+    monkeypatch.setattr(main, "_store", main.MemorySessionStore())
+    # No backoff between attempts: the inline failure costs no wall time
+    monkeypatch.setattr(main.llm_classify_cargo, "__defaults__", (main.LLM_ATTEMPTS_PER_TRY, 0))
+    main._CLASSIFY_CACHE.clear()
+    yield install
+    main._prefetch_cancel_all()
+    main._CLASSIFY_CACHE.clear()
+
+
+async def _say(message: str) -> str:
+    await main.chat(main.ChatRequest(session_id=SID, message=message))
+    return (await main._store.get(SID)).stage
+
+
+async def _fail_cargo() -> None:
+    # Every inline attempt fails, so the turn asks the user to wait and starts the retry
+    for message in ("привет", "оформить страховку", "5 млн"):
+        await _say(message)
+    assert await _say("карандаши") == "cargo_retry"
+    assert SID in main._prefetch
+
+
+def test_background_retry_fills_the_cache(llm):
+    fake = llm(failures=main.LLM_ATTEMPTS_PER_TRY)
+
+    async def run():
+        try:
+            await _fail_cargo()
+            await main._prefetch[SID][1]
+            cached = await main._classify_cache_get(main._classify_cache_key("карандаши"))
+            calls = fake.calls
+            assert await _say("ок") == "cargo_confirm"
+            return cached, calls
+        finally:
+            await main._batcher.stop()
+
+    cached, calls = asyncio.run(run())
+    assert cached == ("CARGO012", "toys")
+    assert fake.calls == calls == main.LLM_ATTEMPTS_PER_TRY + 1  # "ок" took the ready result
+
+
+def test_next_message_waits_for_the_running_retry(llm):
+    fake = llm(failures=main.LLM_ATTEMPTS_PER_TRY)
+
+    async def run():
+        try:
+            fake.gate.clear()  # the retry is still on the wire when the user writes again
+            await _fail_cargo()
+            turn = asyncio.create_task(_say("ок"))
+            await asyncio.sleep(0.05)
+            assert not turn.done()
+            fake.gate.set()
+            return await turn
+        finally:
+            await main._batcher.stop()
+
+    assert asyncio.run(run()) == "cargo_confirm"
+    assert fake.calls == main.LLM_ATTEMPTS_PER_TRY + 1  # no second classification of its own
+
+
+def test_without_a_retry_the_turn_classifies_inline(llm):
+    fake = llm(failures=main.LLM_ATTEMPTS_PER_TRY)
+
+    async def run():
+        try:
+            fake.gate.clear()
+            await _fail_cargo()
+            # As if the next message reached another worker: no background result here
+            task = main._prefetch[SID][1]
+            main._prefetch_cancel(SID)
+            await asyncio.gather(task, return_exceptions=True)
+            before = fake.calls
+            fake.gate.set()
+            return await _say("ок"), task.cancelled(), fake.calls - before
+        finally:
+            await main._batcher.stop()
+
+    stage, retry_cancelled, inline_calls = asyncio.run(run())
+    assert stage == "cargo_confirm"
+    assert retry_cancelled and inline_calls == 1
+    assert SID not in main._prefetch
@@ -0,0 +1,45 @@
+"""
+Tests for the Redis session store's time bounds: a stalled Redis fails the command
+within REDIS_TIMEOUT_SEC, and a failed unlock never replaces the turn's own error.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+
+import fakeredis
+import pytest
+from app import main
+from fastapi import HTTPException
+
+
+class StalledRedis(fakeredis.FakeAsyncRedis):
+    async def get(self, *args, **kwargs):
+        await asyncio.sleep(60)
+
+
+def test_stalled_redis_fails_within_the_command_timeout():
+    store = main.SessionStore(StalledRedis())
+    t0 = time.monotonic()
+    with pytest.raises(TimeoutError):
+        asyncio.run(store.get("s"))
+    assert time.monotonic() - t0 < main.REDIS_TIMEOUT_SEC + 0.5
+
+
+def test_failed_unlock_keeps_the_turn_error(caplog):
+    store = main.SessionStore(fakeredis.FakeAsyncRedis())
+
+    async def broken_unlock(**kwargs):
+        raise ConnectionError("Redis went away")
+
+    store._unlock = broken_unlock
+
+    async def turn():
+        async with store.lock("s"):
+            raise HTTPException(status_code=502, detail="Tariff engine unreachable")
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(turn())
+    assert exc.value.status_code == 502
+    assert "unlock failed" in caplog.text
+
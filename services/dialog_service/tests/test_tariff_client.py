@@ -0,0 +1,31 @@
+"""
+The pooled tariff client belongs to one event loop: a new loop gets a new pool, and
+neither the replaced pool nor the last one at shutdown is left open.
+"""
+from __future__ import annotations
+
+import asyncio
+
+from app import main
+
+
+def test_new_loop_replaces_and_closes_the_old_pool():
+    first = asyncio.run(main._tariff_client())
+    second = asyncio.run(main._tariff_client())
+    try:
+        assert second is not first
+        assert first.is_closed and not second.is_closed
+    finally:
+        asyncio.run(main._close_tariff_client())
+    assert second.is_closed and main._http is None
+
+
+def test_lifespan_closes_the_pool():
+    async def run():
+        async with main.lifespan(main.app):
+            client = await main._tariff_client()
+            assert await main._tariff_client() is client  # reused within the loop
+        return client
+
+    assert asyncio.run(run()).is_closed
+    assert main._http is None
@@ -2,13 +2,18 @@ from __future__ import annotations
 
 import os
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 
 from .models import HealthResponse, QuoteRequest, QuoteResponse, Decision
 from .tariff import TariffConfig, TariffConfigError, load_config, assess, quote
 
 
 def create_app() -> FastAPI:
-    app = FastAPI(title="Cargo Insurance Tariff Engine", version="1.0.0")
+    app = FastAPI(
+        title="Cargo Insurance Tariff Engine",
+        version="1.0.0",
+        default_response_class=ORJSONResponse,
+    )
 
     config_path = os.getenv("TARIFF_CONFIG_PATH", "/app/config/tariff_config.json")
 
@@ -18,19 +23,18 @@ def create_app() -> FastAPI:
         # Fail fast: misconfigured container should not serve traffic.
         raise RuntimeError(str(e))
 
+    # Loaded once per app and read-only: under gunicorn --preload this happens in the
+    # master, so forked workers share it. Handlers close over cfg directly.
     app.state.tariff_config = cfg
 
     @app.get("/health", response_model=HealthResponse)
     def health() -> HealthResponse: 
-        cfg2: TariffConfig = app.state.tariff_config
-        return HealthResponse(status="ok", tariff_version=cfg2.version)
+        return HealthResponse(status="ok", tariff_version=cfg.version)
 
     @app.post("/quote", response_model=QuoteResponse)
     def post_quote(req: QuoteRequest) -> QuoteResponse: 
-        cfg2: TariffConfig = app.state.tariff_config
-
         decision_str, reasons = assess(
-            cfg2,
+            cfg,
             cargo_class_id=req.cargo_class_id,
             sum_insured_rub=req.sum_insured_rub,
             condition=req.condition.value,
@@ -53,7 +57,7 @@ def create_app() -> FastAPI:
                 decision=Decision.DECLINE,
                 premium_rub=None,
                 min_premium_applied=None,
-                tariff_version=cfg2.version,
+                tariff_version=cfg.version,
                 public_breakdown=public_breakdown,
                 reasons=reasons,
             )
@@ -63,7 +67,7 @@ def create_app() -> FastAPI:
                 decision=Decision.REFER,
                 premium_rub=None,
                 min_premium_applied=None,
-                tariff_version=cfg2.version,
+                tariff_version=cfg.version,
                 public_breakdown=public_breakdown,
                 reasons=reasons,
             )
@@ -71,7 +75,7 @@ def create_app() -> FastAPI:
         # AUTO_OK
         try:
             premium, min_applied = quote(
-                cfg2,
+                cfg,
                 cargo_class_id=req.cargo_class_id,
                 sum_insured_rub=req.sum_insured_rub,
                 condition=req.condition.value,
@@ -87,7 +91,7 @@ def create_app() -> FastAPI:
             decision=Decision.AUTO_OK,
             premium_rub=premium,
             min_premium_applied=min_applied,
-            tariff_version=cfg2.version,
+            tariff_version=cfg.version,
             public_breakdown=public_breakdown,
             reasons=reasons,
         )
@@ -2,9 +2,9 @@ from __future__ import annotations
 
 from decimal import Decimal
 from enum import Enum
-from typing import Any, Dict, List, Literal, Optional
+from typing import Annotated, Any, Dict, List, Literal, Optional
 
-from pydantic import BaseModel, Field, condecimal, conint
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class Condition(str, Enum):
@@ -18,14 +18,21 @@ class Decision(str, Enum):
     DECLINE = "DECLINE"
 
 
+SumRub = Annotated[Decimal, Field(gt=0, max_digits=14, decimal_places=2)]
+FranchiseRub = Annotated[int, Field(ge=0, le=10**9)]
+
+
 class QuoteRequest(BaseModel):
+    # Unknown fields are a caller bug (e.g. a misspelled flag), not something to ignore
+    model_config = ConfigDict(extra="forbid")
+
     cargo_class_id: str = Field(..., min_length=3, max_length=64)
-    sum_insured_rub: condecimal(gt=0, max_digits=14, decimal_places=2) = Field(
+    sum_insured_rub: SumRub = Field(
         ...,
         description="Страховая сумма в рублях включая копейки",
     )
     condition: Condition
-    franchise_rub: conint(ge=0, le=10**9)
+    franchise_rub: FranchiseRub
     is_reefer: bool
     route_zone: str = Field(..., min_length=1, max_length=64)
 
@@ -1,27 +1,41 @@
 from __future__ import annotations
 
-import json
 import os
 from dataclasses import dataclass
-from decimal import Decimal, ROUND_HALF_UP, ROUND_CEILING
-from typing import Any, Dict, Tuple
+from decimal import Decimal
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, Tuple
+
+import orjson
 
 
 class TariffConfigError(RuntimeError):
     pass
 
 
-@dataclass(frozen=True)
+# eq=False: configs hash by identity, which is what the memoized assess/quote key on
+@dataclass(frozen=True, eq=False)
 class TariffConfig:
     version: str
     auto_limit_rub: Decimal
     min_premium_rub: Decimal
+    min_premium_kop: int  # min_premium_rub in kopecks, rounded up, for the int compare in quote()
     base_rates: Dict[str, Dict[str, Decimal]]  # cargo -> condition -> rate (fraction)
-    k_franchise: Dict[str, Decimal]            # franchise_rub (string key) -> coeff
-    k_reefer: Dict[str, Decimal]              # "true"/"false" -> coeff
+    k_franchise: Dict[int, Decimal]            # franchise_rub -> coeff
+    k_reefer: Dict[bool, Decimal]             # is_reefer -> coeff
     k_route: Dict[str, Decimal]               # route_zone -> coeff
     rounding_mode: str
     rounding_step_rub: int
+    # Integer mirrors of the coefficients, each multiplied by `scale` (a power of
+    # ten wide enough that every coefficient is an exact integer), for quote().
+    scale: int
+    base_rates_i: Dict[str, Dict[str, int]]
+    k_franchise_i: Dict[int, int]
+    k_reefer_i: Dict[bool, int]
+    k_route_i: Dict[str, int]
+    # Every supported (cargo, condition, franchise, reefer, route) tuple, so the
+    # common eligible request is one membership test in assess().
+    valid_combos: FrozenSet[Tuple[str, str, int, bool, str]]
 
 
 def _d(x: Any) -> Decimal:
@@ -31,12 +45,39 @@ def _d(x: Any) -> Decimal:
         raise TariffConfigError(f"Cannot convert to Decimal: {x!r}") from e
 
 
+def _franchise_key(k: Any) -> int:
+    try:
+        return int(k)
+    except (TypeError, ValueError) as e:
+        raise TariffConfigError(f"k_franchise key must be an integer amount: {k!r}") from e
+
+
+def _reefer_key(k: Any) -> bool:
+    s = str(k).strip().lower()
+    if s not in ("true", "false"):
+        raise TariffConfigError(f"k_reefer key must be \"true\" or \"false\": {k!r}")
+    return s == "true"
+
+
+def _decimal_places(x: Decimal) -> int:
+    exp = x.as_tuple().exponent
+    return -exp if isinstance(exp, int) and exp < 0 else 0
+
+
+def _scaled(x: Decimal, scale: int) -> int:
+    n, d = x.as_integer_ratio()
+    return n * scale // d  # exact: scale covers every decimal place of x
+
+
 def load_config(path: str) -> TariffConfig:
     if not os.path.exists(path):
         raise TariffConfigError(f"Tariff config not found at: {path}")
 
-    with open(path, "r", encoding="utf-8") as f:
-        raw = json.load(f)
+    with open(path, "rb") as f:
+        try:
+            raw = orjson.loads(f.read())
+        except orjson.JSONDecodeError as e:
+            raise TariffConfigError(f"Tariff config is not valid JSON: {e}") from e
 
     try:
         version = str(raw["version"])
@@ -47,8 +88,9 @@ def load_config(path: str) -> TariffConfig:
         for cargo_id, by_cond in raw["base_rates"].items():
             base_rates[cargo_id] = {cond: _d(rate) for cond, rate in by_cond.items()}
 
-        k_franchise = {str(k): _d(v) for k, v in raw["k_franchise"].items()}
-        k_reefer = {str(k).lower(): _d(v) for k, v in raw["k_reefer"].items()}
+        # JSON keys are strings; key the lookups by the request's own types
+        k_franchise = {_franchise_key(k): _d(v) for k, v in raw["k_franchise"].items()}
+        k_reefer = {_reefer_key(k): _d(v) for k, v in raw["k_reefer"].items()}
         k_route = {str(k): _d(v) for k, v in raw["k_route"].items()}
 
         rounding = raw.get("rounding", {})
@@ -61,81 +103,136 @@ def load_config(path: str) -> TariffConfig:
     if rounding_step_rub <= 0:
         raise TariffConfigError("rounding.step_rub must be > 0")
 
+    if not min_premium_rub.is_finite():
+        raise TariffConfigError("min_premium_rub must be a finite number")
+    # Premiums are whole rubles, so rounding a fractional kopeck up keeps `<` exact
+    mp_num, mp_den = min_premium_rub.as_integer_ratio()
+    min_premium_kop = -(-mp_num * 100 // mp_den)
+
+    coeffs = [r for by_cond in base_rates.values() for r in by_cond.values()]
+    coeffs += [*k_franchise.values(), *k_reefer.values(), *k_route.values()]
+    if not all(c.is_finite() for c in coeffs):
+        raise TariffConfigError("Tariff coefficients must be finite numbers")
+    scale = 10 ** max((_decimal_places(c) for c in coeffs), default=0)
+
+    # A reload replaces the config; drop memoized results that pin the old one
+    _assess.cache_clear()
+    _quote.cache_clear()
+
     return TariffConfig(
         version=version,
         auto_limit_rub=auto_limit_rub,
         min_premium_rub=min_premium_rub,
+        min_premium_kop=min_premium_kop,
         base_rates=base_rates,
         k_franchise=k_franchise,
         k_reefer=k_reefer,
         k_route=k_route,
         rounding_mode=rounding_mode,
         rounding_step_rub=rounding_step_rub,
+        scale=scale,
+        base_rates_i={
+            cargo_id: {cond: _scaled(rate, scale) for cond, rate in by_cond.items()}
+            for cargo_id, by_cond in base_rates.items()
+        },
+        k_franchise_i={k: _scaled(v, scale) for k, v in k_franchise.items()},
+        k_reefer_i={k: _scaled(v, scale) for k, v in k_reefer.items()},
+        k_route_i={k: _scaled(v, scale) for k, v in k_route.items()},
+        valid_combos=frozenset(
+            (cargo_id, cond, fr, rf, rz)
+            for cargo_id, by_cond in base_rates.items()
+            for cond in by_cond
+            for fr in k_franchise
+            for rf in k_reefer
+            for rz in k_route
+        ),
     )
 
 
-def assess(cfg: TariffConfig, *, cargo_class_id: str, sum_insured_rub: Decimal,
-           condition: str, franchise_rub: int, is_reefer: bool, route_zone: str) -> Tuple[str, list[str]]:
-    reasons: list[str] = []
+# Hit rates are high: requests cluster on a few buckets and round sums.
+# Keys hold the native lookup values; the franchise and reefer slots never mix, so
+# True == 1 cannot make two different lookups share an entry.
+_MEMO_SIZE = 8192
+
 
+@lru_cache(maxsize=_MEMO_SIZE)
+def _assess(cfg: TariffConfig, cargo_class_id: str, sum_insured: Decimal, cond: str,
+            franchise_rub: int, is_reefer: bool, route_zone: str) -> Tuple[str, Tuple[str, ...]]:
+    if (sum_insured <= cfg.auto_limit_rub
+            and (cargo_class_id, cond, franchise_rub, is_reefer, route_zone) in cfg.valid_combos):
+        return "AUTO_OK", ()
+
+    # Otherwise find the first failing check, in order, for the reason
     # 1) Cargo whitelist + condition
     if cargo_class_id not in cfg.base_rates:
-        return "DECLINE", ["CARGO_NOT_ELIGIBLE"]
+        return "DECLINE", ("CARGO_NOT_ELIGIBLE",)
 
-    cond = str(condition).upper()
     if cond not in cfg.base_rates[cargo_class_id]:
-        return "REFER", ["CONDITION_NOT_SUPPORTED"]
+        return "REFER", ("CONDITION_NOT_SUPPORTED",)
 
     # 2) Limit
-    if _d(sum_insured_rub) > cfg.auto_limit_rub:
-        return "REFER", ["LIMIT_EXCEEDED"]
+    if sum_insured > cfg.auto_limit_rub:
+        return "REFER", ("LIMIT_EXCEEDED",)
 
     # 3) Exact buckets for franchise and route
-    if str(franchise_rub) not in cfg.k_franchise:
-        return "REFER", ["FRANCHISE_NOT_SUPPORTED"]
+    if franchise_rub not in cfg.k_franchise:
+        return "REFER", ("FRANCHISE_NOT_SUPPORTED",)
 
     if route_zone not in cfg.k_route:
-        return "REFER", ["ROUTE_ZONE_NOT_SUPPORTED"]
+        return "REFER", ("ROUTE_ZONE_NOT_SUPPORTED",)
+
+    if is_reefer not in cfg.k_reefer:
+        return "REFER", ("REEFER_FLAG_NOT_SUPPORTED",)
 
-    k_reefer_key = str(is_reefer).lower()
-    if k_reefer_key not in cfg.k_reefer:
-        return "REFER", ["REEFER_FLAG_NOT_SUPPORTED"]
+    return "AUTO_OK", ()
 
-    return "AUTO_OK", reasons
 
+def assess(cfg: TariffConfig, *, cargo_class_id: str, sum_insured_rub: Decimal,
+           condition: str, franchise_rub: int, is_reefer: bool,
+           route_zone: str) -> Tuple[str, list[str]]:
+    decision, reasons = _assess(
+        cfg, cargo_class_id, _d(sum_insured_rub), str(condition).upper(),
+        franchise_rub, is_reefer, route_zone,
+    )
+    return decision, list(reasons)
 
-def _round_money(amount: Decimal, *, step_rub: int, mode: str) -> Decimal:
-    # Round to nearest step (e.g., 1 rub, 10 rub, 100 rub)
-    step = Decimal(step_rub)
-    if step == 1:
-        if mode == "CEIL":
-            return amount.to_integral_value(rounding=ROUND_CEILING)
-        return amount.to_integral_value(rounding=ROUND_HALF_UP)
 
-    # Scale to step
-    scaled = amount / step
+def _round_money(num: int, den: int, *, step_rub: int, mode: str) -> int:
+    # Round the exact amount num/den rubles (den > 0) to a whole step (e.g., 1 rub,
+    # 10 rub, 100 rub): CEIL like ROUND_CEILING, otherwise ROUND_HALF_UP
+    # (ties away from zero).
+    div = den * step_rub
     if mode == "CEIL":
-        rounded = scaled.to_integral_value(rounding=ROUND_CEILING) * step
-    else:
-        rounded = scaled.to_integral_value(rounding=ROUND_HALF_UP) * step
-    return rounded
+        return -(-num // div) * step_rub
+    q, r = divmod(abs(num), div)
+    if 2 * r >= div:
+        q += 1
+    return (q if num >= 0 else -q) * step_rub
+
+
+@lru_cache(maxsize=_MEMO_SIZE)
+def _quote(cfg: TariffConfig, cargo_class_id: str, sum_insured: Decimal, cond: str,
+           franchise_rub: int, is_reefer: bool, route_zone: str) -> Tuple[Decimal, bool]:
+    base_rate = cfg.base_rates_i[cargo_class_id][cond]
+    k_fr = cfg.k_franchise_i[franchise_rub]
+    k_ref = cfg.k_reefer_i[is_reefer]
+    k_route = cfg.k_route_i[route_zone]
+
+    # Exact integer fraction: sum (kopecks or finer) times four scaled coefficients
+    sum_num, sum_den = sum_insured.as_integer_ratio()
+    num = sum_num * base_rate * k_fr * k_ref * k_route
+    den = sum_den * cfg.scale ** 4
+    premium_rounded = _round_money(num, den, step_rub=cfg.rounding_step_rub, mode=cfg.rounding_mode)
+
+    if premium_rounded * 100 < cfg.min_premium_kop:
+        return cfg.min_premium_rub, True
+    return Decimal(premium_rounded), False
 
 
 def quote(cfg: TariffConfig, *, cargo_class_id: str, sum_insured_rub: Decimal,
-          condition: str, franchise_rub: int, is_reefer: bool, route_zone: str) -> Tuple[Decimal, bool]:
-    cond = str(condition).upper()
-    base_rate = cfg.base_rates[cargo_class_id][cond]
-    k_fr = cfg.k_franchise[str(franchise_rub)]
-    k_ref = cfg.k_reefer[str(is_reefer).lower()]
-    k_route = cfg.k_route[route_zone]
-
-    premium_raw = _d(sum_insured_rub) * base_rate * k_fr * k_ref * k_route
-    premium_rounded = _round_money(premium_raw, step_rub=cfg.rounding_step_rub, mode=cfg.rounding_mode)
-
-    min_applied = False
-    premium_final = premium_rounded
-    if premium_final < cfg.min_premium_rub:
-        premium_final = cfg.min_premium_rub
-        min_applied = True
-
-    return premium_final, min_applied
+          condition: str, franchise_rub: int, is_reefer: bool,
+          route_zone: str) -> Tuple[Decimal, bool]:
+    return _quote(
+        cfg, cargo_class_id, _d(sum_insured_rub), str(condition).upper(),
+        franchise_rub, is_reefer, route_zone,
+    )
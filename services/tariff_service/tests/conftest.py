@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Tests import the service the way the container does: `app` from the service root
+sys.path.insert(0, str(ROOT))
+# app.main builds the app at import; point it at the repo's config, not the image path
+os.environ.setdefault("TARIFF_CONFIG_PATH", str(ROOT / "config" / "tariff_config.json"))
@@ -0,0 +1,45 @@
+"""
+The tariff config is loaded once, when the app is built, and every request reads
+that same object from app.state.
+"""
+from __future__ import annotations
+
+from app import main
+from app.tariff import TariffConfig
+from fastapi.testclient import TestClient
+
+QUOTE = {
+    "cargo_class_id": "CARGO003",
+    "sum_insured_rub": 1000000,
+    "condition": "NEW",
+    "franchise_rub": 50000,
+    "is_reefer": False,
+    "route_zone": "РФ",
+}
+
+
+def test_module_app_has_its_config():
+    assert isinstance(main.app.state.tariff_config, TariffConfig)
+
+
+def test_config_is_loaded_once_and_reused(monkeypatch):
+    loads = []
+    real_load = main.load_config
+
+    def counting_load(path):
+        loads.append(path)
+        return real_load(path)
+
+    monkeypatch.setattr(main, "load_config", counting_load)
+    app = main.create_app()
+    cfg = app.state.tariff_config
+    assert len(loads) == 1
+
+    with TestClient(app) as client:
+        for _ in range(3):
+            assert client.get("/health").json()["tariff_version"] == cfg.version
+            r = client.post("/quote", json=QUOTE)
+            assert r.status_code == 200
+            assert r.json()["tariff_version"] == cfg.version
+    assert len(loads) == 1
+    assert app.state.tariff_config is cfg
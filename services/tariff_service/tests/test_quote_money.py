@@ -0,0 +1,122 @@
+"""
+Regression test for the integer premium arithmetic in quote().
+
+quote() computes premiums as exact integer fractions; the reference below is the
+original Decimal formula, evaluated with enough precision to be exact, so any
+rounding or scaling slip in the integer path shows up as a mismatch.
+"""
+from __future__ import annotations
+
+import json
+import random
+from decimal import ROUND_CEILING, ROUND_HALF_UP, Decimal, localcontext
+
+import pytest
+from app.tariff import load_config, quote
+
+BASE_CONFIG = {
+    "version": "test",
+    "auto_limit_rub": 10000000,
+    "min_premium_rub": 500,
+    "base_rates": {"CARGO003": {"NEW": 0.0011, "USED": 0.0015}},
+    "k_franchise": {"20000": 1.0, "50000": 0.9},
+    "k_reefer": {"false": 1.0, "true": 1.25},
+    "k_route": {"РФ": 1.0, "СНГ-РФ": 1.1},
+    "rounding": {"mode": "HALF_UP", "step_rub": 1},
+}
+
+
+def _d(x) -> Decimal:
+    return Decimal(str(x))
+
+
+def reference_quote(raw: dict, *, cargo_class_id: str, sum_insured_rub: Decimal, condition: str,
+                    franchise_rub: int, is_reefer: bool, route_zone: str) -> tuple[Decimal, bool]:
+    with localcontext() as ctx:
+        ctx.prec = 100  # wide enough that the product and the division are exact
+        premium = (
+            _d(sum_insured_rub)
+            * _d(raw["base_rates"][cargo_class_id][condition])
+            * _d(raw["k_franchise"][str(franchise_rub)])
+            * _d(raw["k_reefer"][str(is_reefer).lower()])
+            * _d(raw["k_route"][route_zone])
+        )
+        rounding = raw.get("rounding", {})
+        ceil = str(rounding.get("mode", "HALF_UP")).upper() == "CEIL"
+        mode = ROUND_CEILING if ceil else ROUND_HALF_UP
+        step = Decimal(int(rounding.get("step_rub", 1)))
+        rounded = (premium / step).to_integral_value(rounding=mode) * step
+        min_premium = _d(raw["min_premium_rub"])
+        if rounded < min_premium:
+            return min_premium, True
+        return rounded, False
+
+
+def _load(tmp_path, raw: dict):
+    path = tmp_path / "tariff_config.json"
+    path.write_text(json.dumps(raw, ensure_ascii=False), encoding="utf-8")
+    return load_config(str(path))
+
+
+def _check(cfg, raw: dict, **kw) -> None:
+    got = quote(cfg, **kw)
+    want = reference_quote(raw, **kw)
+    assert got == want, kw
+    assert str(got[0]) == str(want[0]), kw  # same rendering in the JSON response
+
+
+@pytest.mark.parametrize("mode,step,sum_rub,expected", [
+    # 1000 * 0.0015 = 1.5 -> ties round away from zero
+    ("HALF_UP", 1, "1000", Decimal(2)),
+    ("HALF_UP", 1, "999.99", Decimal(1)),
+    ("CEIL", 1, "666.67", Decimal(2)),
+    ("CEIL", 10, "1000", Decimal(10)),
+    ("HALF_UP", 10, "3333.33", Decimal(0)),
+    ("HALF_UP", 10, "3333.34", Decimal(10)),
+])
+def test_rounding_edges(tmp_path, mode, step, sum_rub, expected):
+    raw = dict(BASE_CONFIG, min_premium_rub=0, rounding={"mode": mode, "step_rub": step})
+    cfg = _load(tmp_path, raw)
+    kw = dict(cargo_class_id="CARGO003", sum_insured_rub=Decimal(sum_rub), condition="USED",
+              franchise_rub=20000, is_reefer=False, route_zone="РФ")
+    assert quote(cfg, **kw) == (expected, False)
+    _check(cfg, raw, **kw)
+
+
+@pytest.mark.parametrize("min_premium,premium,applied", [
+    (777.5, Decimal(777), True),
+    (777.5, Decimal(778), False),
+    (0.001, Decimal(1), False),
+])
+def test_fractional_min_premium(tmp_path, min_premium, premium, applied):
+    raw = dict(BASE_CONFIG, min_premium_rub=min_premium, base_rates={"CARGO003": {"NEW": 1}})
+    cfg = _load(tmp_path, raw)
+    got = quote(cfg, cargo_class_id="CARGO003", sum_insured_rub=premium, condition="NEW",
+                franchise_rub=20000, is_reefer=False, route_zone="РФ")
+    assert got[1] is applied
+    assert got[0] == (Decimal(str(min_premium)) if applied else premium)
+
+
+def test_matches_reference_on_random_configs(tmp_path):
+    rng = random.Random(1)
+
+    def coef() -> float:
+        return round(rng.uniform(0.0001, 3), rng.randint(0, 7))
+
+    for _ in range(100):
+        raw = json.loads(json.dumps(BASE_CONFIG))
+        raw["rounding"] = {"mode": rng.choice(["CEIL", "HALF_UP", "half_up"]),
+                           "step_rub": rng.choice([1, 1, 5, 10, 100, 1000])}
+        raw["min_premium_rub"] = rng.choice([0, 500, 777.5, 1e4, 333.333, 0.001])
+        raw["base_rates"]["CARGO003"] = {"NEW": coef(), "USED": coef()}
+        raw["k_franchise"] = {"20000": coef(), "50000": coef()}
+        raw["k_reefer"] = {"false": coef(), "true": coef()}
+        raw["k_route"] = {"РФ": coef(), "СНГ-РФ": coef()}
+        cfg = _load(tmp_path, raw)
+        for _ in range(100):
+            sum_rub = Decimal(rng.randint(1, 10**9)) / rng.choice([1, 10, 100])
+            _check(cfg, raw, cargo_class_id="CARGO003", sum_insured_rub=sum_rub,
+                   condition=rng.choice(["NEW", "USED"]),
+                   franchise_rub=rng.choice([20000, 50000]),
+                   is_reefer=rng.choice([True, False]),
+                   route_zone=rng.choice(["РФ", "СНГ-РФ"]))